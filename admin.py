@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Invoice, CSVInvoice
+from .models import Invoice, CSVInvoice, CategoryRule
 
 @admin.register(Invoice)
 class InvoiceAdmin(admin.ModelAdmin):
@@ -9,4 +9,11 @@ class InvoiceAdmin(admin.ModelAdmin):
 
 @admin.register(CSVInvoice)
 class CSVInvoiceAdmin(admin.ModelAdmin):
-    list_display = ('get_filename', 'date', )
+    list_display = ('get_filename', 'date', 'status', 'created', 'modified',
+        'failed', 'duplicate_of', )
+
+@admin.register(CategoryRule)
+class CategoryRuleAdmin(admin.ModelAdmin):
+    list_display = ('keyword', 'category', 'priority', )
+    list_editable = ('category', 'priority', )
+    list_filter = ('category', )
@@ -1,5 +1,6 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.core import checks
+from django.db.models.signals import post_migrate, post_save, post_delete
 from django.utils.translation import gettext as _
 
 def create_accounting_group(sender, **kwargs):
@@ -15,4 +16,14 @@ class AccountingConfig(AppConfig):
     name = 'accounting'
 
     def ready(self):
+        from .classifier import invalidate_rules
+        from .rollups import invoice_saved, invoice_deleted
+        from .search import check_fts_triggers
+        checks.register(check_fts_triggers, checks.Tags.database)
         post_migrate.connect(create_accounting_group, sender=self)
+        rule = self.get_model('CategoryRule')
+        post_save.connect(invalidate_rules, sender=rule)
+        post_delete.connect(invalidate_rules, sender=rule)
+        invoice = self.get_model('Invoice')
+        post_save.connect(invoice_saved, sender=invoice)
+        post_delete.connect(invoice_deleted, sender=invoice)
@@ -0,0 +1,49 @@
+import random
+import time
+from decimal import Decimal
+
+from accounting.importers import parse_amounts
+from accounting.models import Invoice, CSVInvoice
+
+def make_cells(count, seed=0):
+    """Amounts as found in exported spreadsheets, some repeated"""
+    rnd = random.Random(seed)
+    cells = []
+    for i in range(count):
+        euro, cents = rnd.randint(0, 120000), rnd.randint(0, 99)
+        kind = rnd.randint(0, 4)
+        if kind == 0:
+            cells.append('')
+        elif kind == 1:
+            cells.append(f'€ {euro:,}'.replace(',', '.') + f',{cents:02d}')
+        elif kind == 2:
+            cells.append(f'{euro},{cents:02d}')
+        elif kind == 3:
+            cells.append(f'{euro}')
+        else:
+            cells.append(rnd.choice(['0', '0,00', '100,00', '22,00']))
+    return cells
+
+def bench_amounts(count=1000000):
+    """Legacy path is prepare_float and the float to Decimal conversion
+    Django does for DecimalField, new path is importers.parse_amounts"""
+    cells = make_cells(count)
+    prepare_float = CSVInvoice().prepare_float
+    to_decimal = Invoice._meta.get_field('amount').to_python
+    start = time.perf_counter()
+    legacy = [to_decimal(prepare_float(cell)) for cell in cells]
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parsed = parse_amounts(cells)
+    parsed_time = time.perf_counter() - start
+    #same values once rounded as the database would store them
+    cent = Decimal('0.01')
+    mismatches = sum([1 for a, b in zip(legacy, parsed)
+        if a.quantize(cent) != b.quantize(cent)])
+    return {
+        'cells': count,
+        'prepare_float': round(legacy_time, 3),
+        'parse_amounts': round(parsed_time, 3),
+        'speedup': round(legacy_time / parsed_time, 1),
+        'mismatches': mismatches,
+        }
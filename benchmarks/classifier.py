@@ -0,0 +1,64 @@
+import random
+import string
+import time
+
+from accounting.classifier import Matcher
+
+def make_words(count, rnd):
+    return [''.join(rnd.choice(string.ascii_lowercase)
+        for j in range(rnd.randint(4, 10))) for i in range(count)]
+
+def make_rules(count, seed=0):
+    """Keywords in priority order, some of two words, some sharing a
+    prefix, all with a 'q' so that make_text() matches none of them"""
+    rnd = random.Random(seed)
+    rules = []
+    for i, word in enumerate(make_words(count, rnd)):
+        keyword = word[:2] + 'q' + word[2:]
+        if i % 3 == 0:
+            keyword += ' ' + make_words(1, rnd)[0]
+        elif i % 5 == 0 and rules:
+            keyword = rules[-1][0] + word[:2]
+        rules.append((keyword, 'A%02d' % (i % 100)))
+    return rules
+
+def make_text(size, seed=0):
+    rnd = random.Random(seed)
+    words = [w.replace('q', 'k') for w in make_words(size // 5 + 1, rnd)]
+    return ' '.join(words)[:size]
+
+def scan(rules, text, default):
+    """Keywords one by one, as guess_*_category used to do"""
+    low = text.lower()
+    for keyword, category in rules:
+        if keyword.lower() in low:
+            return category
+    return default
+
+def best_time(func, repeat=5):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_classifier(rules=400, size=24000):
+    """Guessing a category of a text matching no rule, the worst case of
+    all, by scanning keywords, with the trie regex and with a Matcher,
+    which picks one of the two by the number of rules"""
+    rule_list = make_rules(rules)
+    text = make_text(size)
+    trie = Matcher(rule_list, 'A00', min_rules=0)
+    matcher = Matcher(rule_list, 'A00')
+    scan_time = best_time(lambda: scan(rule_list, text, 'A00'))
+    trie_time = best_time(lambda: trie.guess(text))
+    matcher_time = best_time(lambda: matcher.guess(text))
+    return {
+        'rules': rules,
+        'text': size,
+        'scan_ms': round(scan_time * 1000, 3),
+        'trie_ms': round(trie_time * 1000, 3),
+        'matcher_ms': round(matcher_time * 1000, 3),
+        'speedup': round(scan_time / matcher_time, 1),
+        }
@@ -0,0 +1,120 @@
+import csv
+import os
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+from accounting.choices import CAT
+from accounting.fatturapa import OWNER
+from accounting.importers import chunked
+
+FIRST_DAY = date(2015, 1, 1)
+DAYS = 3652
+FIRST_NAMES = ('Mario', 'Giulia', 'Luca', 'Francesca', 'Marco', 'Chiara',
+    'Andrea', 'Elena', 'Paolo', 'Sara')
+LAST_NAMES = ('Rossi', 'Bianchi', 'Romano', 'Colombo', 'Ricci', 'Marino',
+    'Greco', 'Bruno', 'Gallo', 'Conti')
+COMPANIES = ('Edilizia Nova S.r.l.', 'Studio Tecnico Verdi', 'Ferramenta '
+    'Sant\'Antonio', 'Telecom Italia S.p.A.', 'Cartoleria Lombarda',
+    'Autonoleggio Riviera S.r.l.', 'Assicurazioni Generali S.p.A.',
+    'Comune di Bologna', 'Condominio Le Querce', 'Immobiliare Po S.r.l.')
+DESCRIPTIONS = ('Progettazione architettonica', 'Direzione lavori',
+    'Pratica catastale', 'Perizia di stima', 'Noleggio auto',
+    'Fornitura cancelleria', 'Canone telefonico', 'Polizza RC professionale',
+    'Consulenza fiscale', 'Corso di aggiornamento')
+ACTIVE_CAT = [c[0] for c in CAT if c[0].startswith('A')]
+PASSIVE_CAT = [c[0] for c in CAT if c[0].startswith('P')]
+
+def make_invoices(count, seed=0):
+    """Yields the same invoice dicts for the same count and seed, spread
+    over ten years, about a third active"""
+    rnd = random.Random(seed)
+    for i in range(count):
+        active = rnd.random() < 0.35
+        if rnd.random() < 0.6:
+            client = rnd.choice(COMPANIES)
+        else:
+            client = rnd.choice(FIRST_NAMES) + ' ' + rnd.choice(LAST_NAMES)
+        amount = rnd.randint(1000, 2500000) / 100
+        security = round(amount * 0.04, 2) if active else 0
+        yield {
+            'number': f'{i + 1:07d}/{"A" if active else "P"}',
+            'date': FIRST_DAY + timedelta(days=rnd.randrange(DAYS)),
+            'client': client,
+            'active': active,
+            'descr': rnd.choice(DESCRIPTIONS),
+            'amount': amount,
+            'security': security,
+            'vat': round((amount + security) * 0.22, 2),
+            'category': rnd.choice(ACTIVE_CAT if active else PASSIVE_CAT),
+            'paid': rnd.random() < 0.8,
+            }
+
+def format_amount(value):
+    """Italian style, as spreadsheets export it, i.e. '1.234,56'. No euro
+    sign, files are read as latin-1"""
+    return f'{value:,.2f}'.replace(',', ' ').replace('.', ',').replace(
+        ' ', '.')
+
+def write_csv(path, count, seed=0):
+    """A CSV file as CSVInvoice.csv_records reads it, header included"""
+    with open(path, 'w', newline='', encoding='latin-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Numero', 'Cliente', 'Attiva?', 'gg/mm/aa',
+            'Descrizione', 'Imponibile', 'Contributi', 'Iva', 'Categoria',
+            'Pagata?'])
+        for inv in make_invoices(count, seed):
+            writer.writerow([inv['number'], inv['client'],
+                'yes' if inv['active'] else '',
+                inv['date'].strftime('%d/%m/%y'), inv['descr'],
+                format_amount(inv['amount']), format_amount(inv['security']),
+                format_amount(inv['vat']), inv['category'],
+                'yes' if inv['paid'] else ''])
+    return path
+
+def party(tag, name):
+    return (f'<{tag}><DatiAnagrafici><Anagrafica><Denominazione>'
+        f'{escape(name)}</Denominazione></Anagrafica></DatiAnagrafici>'
+        f'</{tag}>')
+
+def fatturapa_body(inv):
+    security = ''
+    if inv['security']:
+        security = ('<DatiCassaPrevidenziale><ImportoContributoCassa>'
+            f'{inv["security"]:.2f}</ImportoContributoCassa>'
+            '</DatiCassaPrevidenziale>')
+    return ('<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento>'
+        f'<Data>{inv["date"].isoformat()}</Data>'
+        f'<Numero>{escape(inv["number"])}</Numero>{security}'
+        '</DatiGeneraliDocumento></DatiGenerali><DatiBeniServizi>'
+        f'<DettaglioLinee><Descrizione>{escape(inv["descr"])}</Descrizione>'
+        f'<PrezzoTotale>{inv["amount"]:.2f}</PrezzoTotale></DettaglioLinee>'
+        f'<DatiRiepilogo><Imposta>{inv["vat"]:.2f}</Imposta></DatiRiepilogo>'
+        '</DatiBeniServizi></FatturaElettronicaBody>')
+
+def write_fatturapa(directory, count, per_file=100, seed=0):
+    """FatturaPA lots of per_file bodies sharing their parties, returns the
+    paths. Files alternate active and passive invoices, as parties do"""
+    paths = []
+    for n, lot in enumerate(chunked(make_invoices(count, seed), per_file)):
+        active = n % 2 == 0
+        for inv in lot:
+            inv['active'] = active
+            if not active:
+                inv['security'] = 0
+        other = lot[0]['client']
+        supplier, client = (OWNER, other) if active else (other, OWNER)
+        path = os.path.join(directory, f'IT01234567890_{n:05d}.xml')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>'
+                '<p:FatturaElettronica versione="FPR12" xmlns:p="http://'
+                'ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">'
+                '<FatturaElettronicaHeader>' +
+                party('CedentePrestatore', supplier) +
+                party('CessionarioCommittente', client) +
+                '</FatturaElettronicaHeader>')
+            for inv in lot:
+                f.write(fatturapa_body(inv))
+            f.write('</p:FatturaElettronica>')
+        paths.append(path)
+    return paths
@@ -0,0 +1,156 @@
+import os
+import platform
+import time
+import tracemalloc
+
+from django.core.cache import cache
+from django.core.files import File
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from accounting.importers import parse_files
+from accounting.models import Invoice, CSVInvoice, InvoiceRollup
+from accounting.views import get_period_chart_data
+from users.models import User
+
+from .generator import write_csv, write_fatturapa, FIRST_DAY
+
+YEAR = 2020
+MONTH = 5
+
+class QueryCounter:
+    """Execute wrapper, counts queries without keeping their SQL"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+def reset():
+    """Empties invoices without a rollup refresh for each of them"""
+    with connection.cursor() as cursor:
+        for model in (Invoice, InvoiceRollup, CSVInvoice):
+            cursor.execute(f'DELETE FROM {model._meta.db_table}')
+    cache.clear()
+
+def store(path, status='R'):
+    with open(path, 'rb') as f:
+        instance = CSVInvoice(csv=File(f, name=os.path.basename(path)),
+            status=status)
+        instance.save()
+    return instance
+
+def ensure_invoices(env):
+    """Invoices of the CSV file, imported once for all read benchmarks"""
+    if Invoice.objects.count() != env['size']:
+        reset()
+        store(env['csv']).parse()
+    cache.clear()
+
+def get_client():
+    user = User.objects.filter(username='benchmark').first()
+    if not user:
+        user = User.objects.create_superuser(username='benchmark',
+            password='benchmark', email='benchmark@example.com')
+    client = Client()
+    client.force_login(user)
+    return client
+
+def prepare_parse_csv(env):
+    reset()
+    instance = store(env['csv'])
+    return instance.parse
+
+def prepare_parse_xml(env):
+    reset()
+    instances = [store(path) for path in env['xml']]
+    return lambda: parse_files(instances)
+
+def prepare_charts(env):
+    ensure_invoices(env)
+    years = range(FIRST_DAY.year, FIRST_DAY.year + 10)
+    return lambda: [get_period_chart_data(year) for year in years]
+
+def prepare_page(name, **kwargs):
+    def prepare(env):
+        ensure_invoices(env)
+        client = get_client()
+        url = reverse(name, kwargs=kwargs)
+        def run():
+            response = client.get(url)
+            assert response.status_code == 200, url
+            if response.streaming:
+                #reads the stream without holding it
+                for chunk in response.streaming_content:
+                    pass
+        return run
+    return prepare
+
+BENCHMARKS = {
+    'parse_csv': prepare_parse_csv,
+    'parse_xml': prepare_parse_xml,
+    'charts': prepare_charts,
+    'index_view': prepare_page('invoices:index'),
+    'year_view': prepare_page('invoices:year', year=YEAR),
+    'month_view': prepare_page('invoices:month', year=YEAR, month=MONTH),
+    'year_download': prepare_page('invoices:year_download', year=YEAR),
+    }
+
+def measure(prepare, env):
+    """Wall time and query count of a run, then peak memory of another one,
+    as tracemalloc slows down what it traces. Worker processes of XML
+    imports are not traced"""
+    run = prepare(env)
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        run()
+        wall = time.perf_counter() - start
+    run = prepare(env)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'wall': round(wall, 4), 'queries': counter.count,
+        'peak_kb': peak // 1024}
+
+def make_files(directory, size, per_file=100):
+    return {'size': size,
+        'csv': write_csv(os.path.join(directory, 'invoices.csv'), size),
+        'xml': write_fatturapa(directory, size, per_file)}
+
+def run_suite(directory, size, names=None, per_file=100):
+    """Results of the named benchmarks (all by default) for size invoices,
+    files are generated in directory"""
+    env = make_files(directory, size, per_file)
+    results = {}
+    for name, prepare in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = measure(prepare, env)
+    return {'size': size, 'database': connection.vendor,
+        'python': platform.python_version(), 'results': results}
+
+def compare(old, new, threshold=1.2):
+    """Lines comparing two suite results and whether something regressed:
+    more queries, or time or memory grown over threshold"""
+    lines = []
+    regressed = False
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        worse = (result['queries'] > before['queries'] or
+            result['wall'] > before['wall'] * threshold or
+            result['peak_kb'] > before['peak_kb'] * threshold)
+        regressed = regressed or worse
+        lines.append(f"{name}: wall {before['wall']} -> {result['wall']}, "
+            f"queries {before['queries']} -> {result['queries']}, "
+            f"peak {before['peak_kb']} -> {result['peak_kb']} KB"
+            + (' REGRESSION' if worse else ''))
+    return lines, regressed
@@ -0,0 +1,63 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+#keys of cached periods include a generation, changed to drop them all
+GENERATION_KEY = 'accounting:period:generation'
+HITS_KEY = 'accounting:period:hits'
+MISSES_KEY = 'accounting:period:misses'
+PARTS = ('items', 'chart')
+
+def get_timeout():
+    return getattr(settings, 'ACCOUNTING_PERIOD_CACHE_TIMEOUT', 3600)
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(GENERATION_KEY, generation, None):
+            generation = cache.get(GENERATION_KEY, generation)
+    return generation
+
+def get_key(generation, year, month, part):
+    """Month is None for a whole year"""
+    return f'accounting:period:{generation}:{year}:{month or 0}:{part}'
+
+def incr(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        #add() loses a race with another process at worst by one count
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+def get_or_compute(year, month, part, compute):
+    """Cached value of a period part, compute() gives it on a miss"""
+    if not get_timeout():
+        return compute()
+    key = get_key(get_generation(), year, month, part)
+    value = cache.get(key)
+    if value is None:
+        incr(MISSES_KEY)
+        value = compute()
+        cache.set(key, value, get_timeout())
+    else:
+        incr(HITS_KEY)
+    return value
+
+def invalidate_periods(periods, everything=False):
+    """Drops the (year, month) periods along with their years"""
+    if everything:
+        cache.set(GENERATION_KEY, uuid.uuid4().hex, None)
+        return
+    generation = get_generation()
+    keys = []
+    for year, month in set(periods):
+        for part in PARTS:
+            keys.append(get_key(generation, year, month, part))
+            keys.append(get_key(generation, year, None, part))
+    cache.delete_many(keys)
+
+def get_stats():
+    return {'hits': cache.get(HITS_KEY, 0), 'misses': cache.get(MISSES_KEY, 0)}
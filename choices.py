@@ -23,3 +23,8 @@ CAT = [('A01PR', 'A-'+_('Architectural design')),
     ('P08DI', 'P-'+_('Dividends')),
     ('P00', 'P-'+_('Various')),
     ]
+
+STATUS = [('P', _('Pending')),
+    ('R', _('Running')),
+    ('D', _('Done')),
+    ]
@@ -0,0 +1,108 @@
+import re
+import uuid
+
+from django.core.cache import cache
+
+from .models import CategoryRule
+
+VERSION_KEY = 'accounting:category_rules'
+#below this many keywords scanning them one by one is faster
+MATCHER_MIN_RULES = 200
+#compiled rules of this process, with the version they were compiled at
+_compiled = {}
+
+def get_trie_pattern(keywords):
+    """Regex of keywords sharing prefixes, so that re follows one branch per
+    character instead of trying every keyword at every position. It matches
+    the longest keyword starting at a position"""
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    def build(node):
+        branches = [re.escape(char) + build(child)
+            for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(
+            branches)
+        return '(?:%s)?' % pattern if '' in node else pattern
+    return build(trie)
+
+class Matcher:
+    """All keywords of a side in one trie shaped regex. Searching again one
+    character after each match finds keywords at every position, and those
+    that are prefixes of the longest one there are known in advance, so the
+    result is the same as checking keywords one by one in priority order.
+    Few keywords are just checked one by one"""
+
+    def __init__(self, rules, default, min_rules=MATCHER_MIN_RULES):
+        self.default = default
+        self.categories = [category for keyword, category in rules]
+        self.keywords = None
+        self.regex = None
+        if len(rules) < min_rules:
+            self.keywords = [(keyword.lower(), i) for i, (keyword, category)
+                in enumerate(rules) if keyword]
+            return
+        index = {}
+        for i, (keyword, category) in enumerate(rules):
+            if keyword:
+                index.setdefault(keyword.lower(), i)
+        #lowest index among keywords each keyword starts with
+        self.best = {keyword: min([index[keyword[:end]]
+            for end in range(1, len(keyword) + 1) if keyword[:end] in index])
+            for keyword in index}
+        self.regex = re.compile(get_trie_pattern(index)) if index else None
+
+    def guess(self, string):
+        best = None
+        if self.keywords is not None:
+            string = string.lower()
+            best = next((i for keyword, i in self.keywords
+                if keyword in string), None)
+        elif self.regex:
+            string = string.lower()
+            search = self.regex.search
+            match = search(string)
+            while match:
+                i = self.best[match.group()]
+                if best is None or i < best:
+                    best = i
+                    if best == 0:
+                        break
+                match = search(string, match.start() + 1)
+        if best is None:
+            return self.default
+        return self.categories[best]
+
+class Classifier:
+
+    def __init__(self, rules):
+        self.active = Matcher([r for r in rules if r[1].startswith('A')],
+            'A00')
+        self.passive = Matcher([r for r in rules if r[1].startswith('P')],
+            'P00')
+
+    def classify(self, record):
+        if record['active']:
+            record['category'] = self.active.guess(record['descr'])
+        else:
+            record['category'] = self.passive.guess(record['client'])
+
+def get_classifier():
+    """Compiled once per process, compiled again when rules change"""
+    version = cache.get(VERSION_KEY, 0)
+    if _compiled.get('version') != version or 'classifier' not in _compiled:
+        rules = list(CategoryRule.objects.values_list('keyword', 'category'))
+        _compiled['classifier'] = Classifier(rules)
+        _compiled['version'] = version
+    return _compiled['classifier']
+
+def invalidate_rules(**kwargs):
+    """Connected to CategoryRule save and delete, tells other processes
+    through the cache"""
+    _compiled.clear()
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,137 @@
+import csv
+import os
+import zipfile
+import zlib
+from datetime import date
+
+from django.utils.translation import gettext as _
+
+from .models import Invoice
+
+#rows fetched from the database at a time while streaming
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FIELDS = ('number', 'client', 'active', 'date', 'descr', 'amount',
+    'security', 'vat', 'category', 'paid')
+#bytes handed to the compressor at a time
+BLOCK_SIZE = 64 * 1024
+COMPRESSIONS = ('gzip', 'zip', 'none')
+EXTENSIONS = {'gzip': '.csv.gz', 'zip': '.zip', 'none': '.csv'}
+CONTENT_TYPES = {'gzip': 'application/gzip', 'zip': 'application/zip',
+    'none': 'text/csv'}
+
+class Echo:
+    """Pseudo buffer, write() returns the line to be streamed"""
+
+    def write(self, value):
+        return value
+
+def csv_rows(qs):
+    """Yields CSV lines of the queryset, reading tuples in chunks. Dates
+    repeat a lot, so each is formatted once"""
+    writer = csv.writer(Echo())
+    yield writer.writerow([_('Number'), _('Client'), _('Active?'),
+        _('dd/mm/yy'), _('Description'), _('Taxable'), _('Social security'),
+        _('VAT'), _('Category'), _('Paid?')])
+    dates = {}
+    for (number, client, active, date, descr, amount, security, vat,
+        category, paid) in qs.values_list(*EXPORT_FIELDS).iterator(
+        chunk_size=EXPORT_CHUNK_SIZE):
+        if date not in dates:
+            dates[date] = '%02d/%02d/%02d' % (date.day, date.month,
+                date.year % 100)
+        yield writer.writerow([number, client, 'yes' if active else '',
+            dates[date], descr, amount, security, vat, category,
+            'yes' if paid else ''])
+
+def filter_invoices(start=None, end=None, active=None, category=None,
+    paid=None):
+    """Invoices dated from start to end (both included), None means any"""
+    qs = Invoice.objects.all()
+    if start:
+        qs = qs.filter(date__gte=start)
+    if end:
+        qs = qs.filter(date__lte=end)
+    if active is not None:
+        qs = qs.filter(active=active)
+    if category:
+        qs = qs.filter(category=category)
+    if paid is not None:
+        qs = qs.filter(paid=paid)
+    return qs
+
+def blocks(lines):
+    """Joins lines into encoded blocks of about BLOCK_SIZE bytes"""
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= BLOCK_SIZE:
+            yield ''.join(block).encode()
+            block = []
+            size = 0
+    if block:
+        yield ''.join(block).encode()
+
+def gzip_stream(lines):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks(lines):
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class ZipBuffer:
+    """Write only file for ZipFile, emptied after each write to the archive.
+    It can't seek, so ZipFile writes sizes after the data"""
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+def zip_stream(lines, name):
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(name, 'w', force_zip64=True) as member:
+            for block in blocks(lines):
+                member.write(block)
+                data = buffer.pop()
+                if data:
+                    yield data
+    yield buffer.pop()
+
+def compress(lines, compression, name):
+    """Byte stream of CSV lines, name is the file within zip archives"""
+    if compression == 'gzip':
+        return gzip_stream(lines)
+    if compression == 'zip':
+        return zip_stream(lines, name)
+    return blocks(lines)
+
+def get_extension(compression):
+    return EXTENSIONS[compression]
+
+def get_content_type(compression):
+    return CONTENT_TYPES[compression]
+
+def export_year(year, directory, compression='gzip', **filters):
+    """Writes invoices of the year to a file of the directory, returns its
+    path. Runs in worker processes of the export_invoices command"""
+    name = '%(invoices)s-%(year)d' % {'invoices': _('Invoices'), 'year': year}
+    path = os.path.join(directory, name + get_extension(compression))
+    qs = filter_invoices(date(year, 1, 1), date(year, 12, 31), **filters)
+    with open(path, 'wb') as f:
+        for data in compress(csv_rows(qs), compression, name + '.csv'):
+            f.write(data)
+    return path
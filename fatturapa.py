@@ -0,0 +1,95 @@
+from datetime import datetime
+import xml.etree.ElementTree as ET
+
+#this module only uses the standard library, so that it can run in worker
+#processes that don't set up Django
+
+OWNER = 'Associazione Professionale Perilli'
+PARTIES = ('CedentePrestatore', 'CessionarioCommittente')
+NAMES = ('Denominazione', 'Nome', 'Cognome')
+#first occurrence in each body
+FIRST = ('Data', 'Numero')
+#all occurrences in each body
+ALL = ('ImportoContributoCassa', 'Descrizione', 'PrezzoTotale', 'Imposta')
+BODY = 'FatturaElettronicaBody'
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+def get_name(party):
+    if 'Denominazione' in party:
+        return party['Denominazione']
+    return party['Nome'] + ' ' + party['Cognome']
+
+def make_record(parties, body):
+    """Returns None if the invoice lacks something"""
+    try:
+        cp = parties['CedentePrestatore']
+        if cp.get('Denominazione') == OWNER:
+            active = True
+            client = get_name(parties['CessionarioCommittente'])
+        else:
+            active = False
+            client = get_name(cp)
+        return {
+            'number': body['Numero'],
+            'date': datetime.strptime(body['Data'], '%Y-%m-%d').date(),
+            'client': client,
+            'active': active,
+            'descr': ''.join([(d or '') + '\n' for d in body['Descrizione']]),
+            'amount': sum([float(a) for a in body['PrezzoTotale']]),
+            'security': sum([float(s) for s in
+                body['ImportoContributoCassa']]),
+            'vat': sum([float(v) for v in body['Imposta']]),
+            'category': None,
+            'paid': False
+            }
+    except Exception:
+        return None
+
+def extract_invoices(path):
+    """Returns a record (None if it fails) for each FatturaElettronicaBody
+    of a FatturaPA file, or for the whole file if there is no body element.
+    The file is read in a single pass, dropping elements once read.
+    Category is left to the caller, as it needs the classifier"""
+    parties = {}
+    party = None
+    body = {tag: [] for tag in ALL}
+    bodies = 0
+    records = []
+    stack = []
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = local_name(elem.tag)
+        if event == 'start':
+            stack.append(elem)
+            if tag in PARTIES and party is None:
+                party = tag
+                parties.setdefault(tag, {})
+            elif tag == BODY:
+                body = {tag: [] for tag in ALL}
+            continue
+        stack.pop()
+        if tag == party:
+            party = None
+        elif party and tag in NAMES:
+            parties[party].setdefault(tag, elem.text)
+        elif tag in FIRST:
+            body.setdefault(tag, elem.text)
+        elif tag in ALL:
+            body[tag].append(elem.text)
+        elif tag == BODY:
+            records.append(make_record(parties, body))
+            bodies += 1
+        if stack:
+            #parent keeps no more than the child being parsed
+            stack[-1].remove(elem)
+    if not bodies:
+        records.append(make_record(parties, body))
+    return records
+
+def try_extract_invoices(path):
+    """None if the file can't be read, exceptions may not pickle"""
+    try:
+        return extract_invoices(path)
+    except Exception:
+        return None
@@ -1,7 +1,11 @@
+from datetime import date
+
 from django import forms
 from django.forms import ModelForm
+from django.utils.timezone import now
 from django.utils.translation import gettext as _
 
+from .choices import CAT
 from .models import Invoice, CSVInvoice
 
 class InvoiceCreateForm(ModelForm):
@@ -36,3 +40,58 @@ class CSVInvoiceCreateForm(ModelForm):
     class Meta:
         model = CSVInvoice
         fields = ('csv', )
+
+class InvoiceExportForm(forms.Form):
+    start = forms.DateField(label=_("From"), required=False)
+    end = forms.DateField(label=_("To"), required=False)
+    active = forms.NullBooleanField(label=_("Active?"), required=False)
+    category = forms.ChoiceField(label=_("Category"), required=False,
+        choices=[('', '---------')] + CAT)
+    paid = forms.NullBooleanField(label=_("Paid?"), required=False)
+    compression = forms.ChoiceField(required=False, choices=[
+        ('gzip', 'gzip'), ('zip', 'zip'), ('none', _("None"))])
+
+    def clean(self):
+        cd = super().clean()
+        if cd.get('start') and cd.get('end') and cd['start'] > cd['end']:
+            raise forms.ValidationError(_("Range ends before it starts"),
+                code='bad_range')
+        if not cd.get('compression'):
+            cd['compression'] = 'gzip'
+        return cd
+
+class VATReportForm(forms.Form):
+    start = forms.DateField(label=_("From"), required=False,
+        help_text=_("Beginning of this year if empty"))
+    end = forms.DateField(label=_("To"), required=False,
+        help_text=_("End of this year if empty"))
+    period = forms.ChoiceField(label=_("Period"), required=False, choices=[
+        ('month', _("Month")), ('quarter', _("Quarter"))])
+
+    def clean(self):
+        cd = super().clean()
+        year = now().year
+        if not cd.get('start'):
+            cd['start'] = date(year, 1, 1)
+        if not cd.get('end'):
+            cd['end'] = date(year, 12, 31)
+        if cd['start'] > cd['end']:
+            raise forms.ValidationError(_("Range ends before it starts"),
+                code='bad_range')
+        if not cd.get('period'):
+            cd['period'] = 'month'
+        return cd
+
+class AgingReportForm(forms.Form):
+    date = forms.DateField(label=_("As of"), required=False,
+        help_text=_("Today if empty"))
+
+    def clean(self):
+        cd = super().clean()
+        if not cd.get('date'):
+            cd['date'] = now().date()
+        return cd
+
+class InvoiceSearchForm(forms.Form):
+    q = forms.CharField(label=_("Search"), max_length=200,
+        help_text=_("Words in client or reason"))
@@ -0,0 +1,280 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction, DataError, IntegrityError
+
+from .classifier import get_classifier
+from .fatturapa import try_extract_invoices
+from .instrumentation import measure_import
+from .models import Invoice, CSVInvoice
+from .rollups import refresh_periods
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+#rows written (and progress saved) per transaction while streaming a file
+CHUNK_SIZE = 500
+FIELDS = ('client', 'active', 'descr', 'amount', 'security', 'vat',
+    'category', 'paid')
+AMOUNTS = ('amount', 'security', 'vat')
+UNIQUE_FIELDS = ('number', 'date')
+#Invoice decimal fields have max_digits=8, decimal_places=2
+AMOUNT_LIMIT = Decimal('999999.995')
+ZERO = Decimal('0')
+
+def parse_amount(value):
+    """Italian formatted money to Decimal, i.e. '€ 1.234,56'. As in
+    CSVInvoice.prepare_float the last '.' or ',' is the decimal point and
+    the others are thousands separators"""
+    if not value:
+        return ZERO
+    if '€' in value:
+        value = value.replace('€', '')
+    if ',' in value:
+        if '.' not in value and value.count(',') == 1:
+            return Decimal(value.replace(',', '.'))
+    elif value.count('.') < 2:
+        return Decimal(value)
+    i = max(value.rfind('.'), value.rfind(','))
+    return Decimal(value[:i].replace('.', '').replace(',', '') + '.' +
+        value[i + 1:])
+
+def parse_amounts(values):
+    """Converts a column, parsing each distinct cell once. Cells that
+    can't be parsed or don't fit Invoice fields become None"""
+    parsed = {}
+    result = []
+    for value in values:
+        if value not in parsed:
+            try:
+                amount = parse_amount(value)
+                if not -AMOUNT_LIMIT < amount < AMOUNT_LIMIT:
+                    amount = None
+            except InvalidOperation:
+                amount = None
+            parsed[value] = amount
+        result.append(parsed[value])
+    return result
+
+def convert_amounts(records, counters):
+    """Turns the amount columns of a chunk of records into Decimals,
+    dropping (and counting as failed) records with a bad amount"""
+    columns = [parse_amounts([r[field] for r in records])
+        for field in AMOUNTS]
+    converted = []
+    for record, amounts in zip(records, zip(*columns)):
+        if None in amounts:
+            counters.failed += 1
+            continue
+        record['amount'], record['security'], record['vat'] = amounts
+        converted.append(record)
+    return converted
+
+class Counters:
+
+    def __init__(self):
+        self.created = 0
+        self.modified = 0
+        self.failed = 0
+
+class InvoiceUpserter(Counters):
+    """Writes invoice records with bulk_create / bulk_update, counting them
+    as update_or_create on (number, date) would do row by row. Records may
+    be tagged (i.e. with the CSVInvoice they come from) to keep separate
+    counters in self.tags"""
+
+    def __init__(self, batch_size=BATCH_SIZE, native=None):
+        super().__init__()
+        self.batch_size = batch_size
+        self.tags = {}
+        #INSERT ... ON CONFLICT (number, date) DO UPDATE where available
+        if native is None:
+            native = (getattr(settings, 'ACCOUNTING_NATIVE_UPSERT', True)
+                and connection.features.supports_update_conflicts_with_target)
+        self.native = native
+
+    def count(self, field, tag, n=1):
+        setattr(self, field, getattr(self, field) + n)
+        if tag is not None:
+            counters = self.tags.setdefault(tag, Counters())
+            setattr(counters, field, getattr(counters, field) + n)
+
+    def get_existing(self, records):
+        """Maps (number, date) to id for invoices matching the records, None
+        marks keys that match more than one invoice"""
+        dates = [r['date'] for r in records]
+        numbers = set(r['number'] for r in records)
+        existing = {}
+        qs = Invoice.objects.filter(date__range=(min(dates), max(dates)),
+            number__in=numbers)
+        for id, number, date in qs.values_list('id', 'number', 'date'):
+            key = (number, date)
+            existing[key] = None if key in existing else id
+        return existing
+
+    def upsert(self, records, tags=None):
+        """Records are dicts with number, date and FIELDS, in file order"""
+        if not records:
+            return
+        if tags is None:
+            tags = [None] * len(records)
+        existing = self.existing = self.get_existing(records)
+        merged = {}
+        #for each key, tag and whether its rows created or modified
+        self.rows = {}
+        for record, tag in zip(records, tags):
+            key = (record['number'], record['date'])
+            if key in existing and existing[key] is None:
+                #get() would raise MultipleObjectsReturned
+                self.count('failed', tag)
+                continue
+            modified = key in existing or key in merged
+            self.count('modified' if modified else 'created', tag)
+            merged[key] = record
+            self.rows.setdefault(key, []).append((tag, modified))
+        with transaction.atomic():
+            if self.native:
+                #existing rows are still needed above to count them
+                self.write([Invoice(**record) for record in merged.values()],
+                    None)
+            else:
+                self.write([Invoice(**record) for key, record in
+                    merged.items() if key not in existing], True)
+                self.write([Invoice(id=existing[key], **record) for key, record
+                    in merged.items() if key in existing], False)
+            #bulk writes send no signals
+            refresh_periods([(key[1].year, key[1].month) for key in merged])
+
+    def write(self, objs, create):
+        """Create is None for native upserts"""
+        for i in range(0, len(objs), self.batch_size):
+            batch = objs[i:i + self.batch_size]
+            try:
+                with transaction.atomic():
+                    if create is None:
+                        Invoice.objects.bulk_create(batch,
+                            update_conflicts=True, unique_fields=UNIQUE_FIELDS,
+                            update_fields=FIELDS)
+                    elif create:
+                        Invoice.objects.bulk_create(batch)
+                    else:
+                        Invoice.objects.bulk_update(batch, FIELDS)
+            except (IntegrityError, DataError):
+                #some row breaks the batch, find it out one by one. Other
+                #errors (e.g. the database going away) are raised
+                self.write_rows(batch, create)
+
+    def write_rows(self, objs, create):
+        native = create is None
+        for obj in objs:
+            if native:
+                key = (obj.number, obj.date)
+                obj.id = self.existing.get(key)
+                create = key not in self.existing
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=create, force_update=not create)
+            except (IntegrityError, DataError):
+                if create:
+                    obj.id = None
+                for tag, modified in self.rows[(obj.number, obj.date)]:
+                    self.count('modified' if modified else 'created', tag, -1)
+                    self.count('failed', tag)
+
+def chunked(iterable, size):
+    """Yields lists of at most size items, holding one list at a time"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def copy_counters(tags):
+    copies = {}
+    for tag, counters in tags.items():
+        copies[tag] = Counters()
+        copies[tag].created = counters.created
+        copies[tag].modified = counters.modified
+        copies[tag].failed = counters.failed
+    return copies
+
+def import_xml_files(instances, max_workers=None):
+    """Extracts XML files in a process pool, while this process classifies
+    and writes their invoices in batches. Counters go to each instance. If
+    something breaks, files already written keep their counters, the
+    others fail, then the exception is raised again"""
+    if max_workers is None:
+        max_workers = getattr(settings, 'ACCOUNTING_XML_WORKERS', None)
+    paths = [instance.csv.path for instance in instances]
+    upserter = InvoiceUpserter()
+    #counters of files written so far, batches end between files
+    written = {}
+    records = []
+    tags = []
+    executor = None
+    try:
+        classifier = get_classifier()
+        if len(paths) > 1 and max_workers != 1:
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+            results = executor.map(try_extract_invoices, paths,
+                chunksize=max(1, len(paths) // 32))
+        else:
+            results = map(try_extract_invoices, paths)
+        for instance, result in zip(instances, results):
+            upserter.tags[instance.id] = Counters()
+            if result is None:
+                upserter.count('failed', instance.id)
+                continue
+            for record in result:
+                if record is None:
+                    upserter.count('failed', instance.id)
+                    continue
+                classifier.classify(record)
+                records.append(record)
+                tags.append(instance.id)
+            if len(records) >= CHUNK_SIZE:
+                upserter.upsert(records, tags)
+                written = copy_counters(upserter.tags)
+                records = []
+                tags = []
+        upserter.upsert(records, tags)
+    except Exception:
+        for instance in instances:
+            if instance.id not in written:
+                written[instance.id] = Counters()
+                written[instance.id].failed = 1
+            instance.save_counters(written[instance.id])
+        raise
+    finally:
+        if executor:
+            executor.shutdown()
+    for instance in instances:
+        instance.save_counters(upserter.tags[instance.id])
+
+def parse_files(instances):
+    """Parses saved CSVInvoice files, XML files all together. Anomalies of
+    the files are counted as failed, anything else (e.g. the database going
+    away) is logged and raised again once the files are done"""
+    xml = []
+    try:
+        for instance in instances:
+            if instance.duplicate_of_id:
+                continue
+            if instance.get_filename().split('.')[1].lower() == 'xml':
+                xml.append(instance)
+            else:
+                instance.parse()
+        if xml:
+            with measure_import('xml', xml):
+                import_xml_files(xml)
+    except Exception:
+        logger.exception('Import of %s file(s) failed', len(instances))
+        raise
+    finally:
+        CSVInvoice.objects.filter(id__in=[i.id for i in instances]).update(
+            status='D')
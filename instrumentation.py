@@ -0,0 +1,203 @@
+import logging
+import socket
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+#ACCOUNTING_METRICS lists dotted paths of backends, none by default. With no
+#backend every hook below returns at once, without timing anything
+logger = logging.getLogger('accounting.metrics')
+_backends = None
+
+class LoggingBackend:
+    """Logs metrics to the accounting.metrics logger"""
+
+    def emit(self, kind, name, value, tags):
+        logger.info('%s %s=%s %s', kind, name, value, ' '.join(
+            f'{k}={v}' for k, v in sorted(tags.items())))
+
+class PrometheusBackend:
+    """Keeps metrics of this process for the metrics view, in Prometheus
+    text format. Timings become _sum and _count series"""
+    values = {}
+
+    def emit(self, kind, name, value, tags):
+        name = name.replace('.', '_')
+        labels = tuple(sorted(tags.items()))
+        if kind == 'timing':
+            for suffix, add in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + add
+        elif kind == 'counter':
+            self.values[(name, labels)] = self.values.get((name, labels),
+                0) + value
+        else:
+            self.values[(name, labels)] = value
+
+    @classmethod
+    def render(cls):
+        lines = []
+        for (name, labels), value in sorted(cls.values.items()):
+            label = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label}}} {value}' if label else
+                f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+class StatsDBackend:
+    """Sends UDP datagrams to ACCOUNTING_STATSD_HOST, tags the DogStatsD
+    way. Datagrams that can't be sent are dropped"""
+    TYPES = {'timing': 'ms', 'counter': 'c', 'gauge': 'g'}
+
+    def __init__(self):
+        self.address = (getattr(settings, 'ACCOUNTING_STATSD_HOST',
+            'localhost'), getattr(settings, 'ACCOUNTING_STATSD_PORT', 8125))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, kind, name, value, tags):
+        if kind == 'timing':
+            value = round(value * 1000, 3)
+        line = f'{name}:{value}|{self.TYPES[kind]}'
+        if tags:
+            line += '|#' + ','.join(f'{k}:{v}' for k, v in
+                sorted(tags.items()))
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError:
+            pass
+
+def get_backends():
+    global _backends
+    if _backends is None:
+        _backends = [import_string(path)() for path in
+            getattr(settings, 'ACCOUNTING_METRICS', [])]
+    return _backends
+
+@receiver(setting_changed)
+def reset_backends(setting, **kwargs):
+    global _backends
+    if setting in ('ACCOUNTING_METRICS', 'ACCOUNTING_STATSD_HOST',
+        'ACCOUNTING_STATSD_PORT'):
+        _backends = None
+
+def emit(kind, name, value, tags):
+    for backend in get_backends():
+        backend.emit(kind, name, value, tags)
+
+def timing(name, seconds, **tags):
+    emit('timing', name, seconds, tags)
+
+def incr(name, value=1, **tags):
+    emit('counter', name, value, tags)
+
+def gauge(name, value, **tags):
+    emit('gauge', name, value, tags)
+
+class QueryTimer:
+    """Execute wrapper counting queries and the time they take"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+@contextmanager
+def timer(name, **tags):
+    if not get_backends():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start, **tags)
+
+def measure_view(name, func, *args, **kwargs):
+    """Runs a view, timing it with its queries. Template responses are left
+    for the handler to render, after template response middleware, and
+    their metrics are sent once rendered, with queries of the template"""
+    if not get_backends():
+        return func(*args, **kwargs)
+    queries = QueryTimer()
+    start = time.perf_counter()
+    with connection.execute_wrapper(queries):
+        response = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    def send(render):
+        tags = {'view': name, 'status': response.status_code}
+        timing('accounting.view.seconds', seconds + render, **tags)
+        timing('accounting.view.db_seconds', queries.seconds, **tags)
+        timing('accounting.view.render_seconds', render, **tags)
+        incr('accounting.view.queries', queries.count, **tags)
+
+    if not hasattr(response, 'render') or response.is_rendered:
+        send(0)
+        return response
+    render = response.render
+
+    def timed_render():
+        if response.is_rendered:
+            return render()
+        render_start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            rendered = render()
+        send(time.perf_counter() - render_start)
+        return rendered
+
+    response.render = timed_render
+    return response
+
+def instrument_view(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return measure_view(view.__name__, view, request, *args, **kwargs)
+    return wrapper
+
+class InstrumentedViewMixin:
+    """Goes first among bases, so that permission checks are measured"""
+
+    def dispatch(self, request, *args, **kwargs):
+        return measure_view(type(self).__name__, super().dispatch, request,
+            *args, **kwargs)
+
+@contextmanager
+def measure_import(kind, instances):
+    """Times the import of CSVInvoice instances, telling database time from
+    parsing, and counts their rows and bytes"""
+    if not get_backends():
+        yield
+        return
+    queries = QueryTimer()
+    start = time.perf_counter()
+    with connection.execute_wrapper(queries):
+        yield
+    seconds = time.perf_counter() - start
+    rows = sum([i.created + i.modified + i.failed for i in instances])
+    size = 0
+    for instance in instances:
+        try:
+            size += instance.csv.size
+        except (OSError, ValueError):
+            pass
+    timing('accounting.import.seconds', seconds, kind=kind)
+    timing('accounting.import.db_seconds', queries.seconds, kind=kind)
+    timing('accounting.import.parse_seconds', seconds - queries.seconds,
+        kind=kind)
+    incr('accounting.import.rows', rows, kind=kind)
+    incr('accounting.import.bytes', size, kind=kind)
+    if seconds:
+        gauge('accounting.import.rows_per_second', round(rows / seconds, 1),
+            kind=kind)
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models.functions import ExtractYear
+
+from accounting.exports import COMPRESSIONS, filter_invoices, export_year
+
+def init_worker():
+    #needed by spawned processes, forked ones already have it
+    django.setup()
+
+def get_years(start, end, **filters):
+    qs = filter_invoices(**filters)
+    if start:
+        qs = qs.filter(date__year__gte=start)
+    if end:
+        qs = qs.filter(date__year__lte=end)
+    return sorted(qs.order_by().annotate(year=ExtractYear('date')).values_list(
+        'year', flat=True).distinct())
+
+def parse_bool(value):
+    if value is None:
+        return None
+    return value == 'yes'
+
+class Command(BaseCommand):
+    help = 'Writes a compressed CSV file of invoices for each year'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Where files are written')
+        parser.add_argument('--start', type=int, help='First year')
+        parser.add_argument('--end', type=int, help='Last year')
+        parser.add_argument('--active', choices=('yes', 'no'))
+        parser.add_argument('--category')
+        parser.add_argument('--paid', choices=('yes', 'no'))
+        parser.add_argument('--compression', choices=COMPRESSIONS,
+            default='gzip')
+        parser.add_argument('--workers', type=int,
+            help='Worker processes, 1 exports in this process')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f'No such directory: {directory}')
+        filters = {'active': parse_bool(options['active']),
+            'category': options['category'],
+            'paid': parse_bool(options['paid'])}
+        years = get_years(options['start'], options['end'], **filters)
+        export = partial(export_year, directory=directory,
+            compression=options['compression'], **filters)
+        if len(years) > 1 and options['workers'] != 1:
+            #each worker opens its own connections, none may be inherited
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'],
+                initializer=init_worker) as executor:
+                paths = list(executor.map(export, years))
+        else:
+            paths = [export(year) for year in years]
+        for path in paths:
+            self.stdout.write(path)
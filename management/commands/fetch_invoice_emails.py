@@ -1,38 +1,86 @@
+import hashlib
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils.translation import gettext as _
 
-from imap_tools import MailBox, AND
+from imap_tools import MailBox, MailBoxUnencrypted, AND, U
 
-from accounting.models import CSVInvoice
+from accounting.instrumentation import timer, incr
+from accounting.models import CSVInvoice, MailCheckpoint
 from users.models import User
 
-def do_command():
-
-    if not settings.FETCH_EMAILS:
-        return
-
+def get_mailbox():
+    """Logged in INBOX, IMAP_SSL = False allows a local stand-in server"""
     HOST = settings.IMAP_HOST
     USER = settings.IMAP_USER
     PASSWORD = settings.IMAP_PWD
     PORT = settings.IMAP_PORT
-    FROM = settings.IMAP_FROM
-
-    with MailBox(HOST).login(USER, PASSWORD, 'INBOX') as mailbox:
-        for message in mailbox.fetch(AND(seen=False, subject=_('invoices'), ),
-            mark_seen=True):
-            try:
-                usr = User.objects.get(email=message.from_)
-                if not usr.has_perm('accounting.add_csvinvoice'):
-                    continue
-            except:
+
+    if getattr(settings, 'IMAP_SSL', True):
+        mailbox = MailBox(HOST, port=PORT)
+    else:
+        mailbox = MailBoxUnencrypted(HOST, port=PORT)
+    with timer('accounting.imap.seconds', step='login'):
+        return mailbox.login(USER, PASSWORD, 'INBOX')
+
+def get_checkpoint(mailbox):
+    """Checkpoint of INBOX, reset if the server renumbered its UIDs"""
+    checkpoint, created = MailCheckpoint.objects.get_or_create(
+        mailbox=f'{settings.IMAP_USER}@{settings.IMAP_HOST}/INBOX')
+    validity = str(mailbox.folder.status('INBOX',
+        ['UIDVALIDITY'])['UIDVALIDITY'])
+    if checkpoint.uid_validity != validity:
+        checkpoint.uid_validity = validity
+        checkpoint.last_uid = 0
+        checkpoint.save()
+    return checkpoint
+
+def fetch_messages(mailbox):
+    """Saves attachments of unseen messages sent by accounting users,
+    skipping messages below the UID checkpoint and known attachments"""
+    checkpoint = get_checkpoint(mailbox)
+    if checkpoint.last_uid:
+        criteria = AND(seen=False, subject=_('invoices'),
+            uid=U(checkpoint.last_uid + 1, '*'))
+    else:
+        criteria = AND(seen=False, subject=_('invoices'), )
+    #attachments are parsed meanwhile, see accounting.import metrics
+    with timer('accounting.imap.seconds', step='fetch'):
+        allowed = {}
+        for message in mailbox.fetch(criteria, mark_seen=True):
+            uid = int(message.uid)
+            #UID n:* always returns the last message, even if below n
+            if uid <= checkpoint.last_uid:
                 continue
-            for att in message.attachments:  # list: [Attachment objects]
-                file = SimpleUploadedFile(att.filename, att.payload,
-                    att.content_type)
-                instance = CSVInvoice(csv=file)
-                instance.save()
+            if message.from_ not in allowed:
+                try:
+                    usr = User.objects.get(email=message.from_)
+                    allowed[message.from_] = usr.has_perm(
+                        'accounting.add_csvinvoice')
+                except:
+                    allowed[message.from_] = False
+            if allowed[message.from_]:
+                for att in message.attachments:  # list: [Attachment objects]
+                    digest = hashlib.sha256(att.payload).hexdigest()
+                    if CSVInvoice.objects.filter(sha256=digest).exists():
+                        continue
+                    file = SimpleUploadedFile(att.filename, att.payload,
+                        att.content_type)
+                    instance = CSVInvoice(csv=file, sha256=digest)
+                    instance.save()
+                    incr('accounting.imap.attachments')
+            checkpoint.last_uid = uid
+            checkpoint.save(update_fields=['last_uid'])
+
+def do_command():
+
+    if not settings.FETCH_EMAILS:
+        return
+
+    with get_mailbox() as mailbox:
+        fetch_messages(mailbox)
 
 class Command(BaseCommand):
 
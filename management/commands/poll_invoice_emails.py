@@ -0,0 +1,54 @@
+import imaplib
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, close_old_connections, DatabaseError
+
+from imap_tools.errors import ImapToolsError
+
+from accounting.management.commands import fetch_invoice_emails
+
+class Command(BaseCommand):
+    help = 'Keeps one IMAP session open and fetches invoices as mail arrives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=300,
+            help='Seconds between checks, or IDLE timeout')
+        parser.add_argument('--no-idle', action='store_true',
+            help='Check every interval instead of waiting with IDLE')
+        parser.add_argument('--rounds', type=int, default=0,
+            help='Stop after this many checks (0 runs forever)')
+
+    def wait(self, mailbox, options):
+        if options['no_idle']:
+            time.sleep(options['interval'])
+        else:
+            #returns as soon as the server announces new messages
+            mailbox.idle.wait(timeout=options['interval'])
+
+    def handle(self, *args, **options):
+        if not settings.FETCH_EMAILS:
+            return
+        rounds = 0
+        while True:
+            try:
+                with fetch_invoice_emails.get_mailbox() as mailbox:
+                    while True:
+                        #as between requests, drops broken or old database
+                        #connections. Never inside a transaction (i.e. tests)
+                        if not connection.in_atomic_block:
+                            close_old_connections()
+                        fetch_invoice_emails.fetch_messages(mailbox)
+                        rounds += 1
+                        if rounds == options['rounds']:
+                            return
+                        self.wait(mailbox, options)
+            except (OSError, imaplib.IMAP4.error, ImapToolsError) as e:
+                #connection dropped, log in again after a pause
+                self.stderr.write(f'IMAP error: {e}')
+                time.sleep(options['interval'])
+            except DatabaseError as e:
+                #the connection is replaced next round
+                self.stderr.write(f'Database error: {e}')
+                time.sleep(options['interval'])
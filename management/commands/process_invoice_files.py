@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, close_old_connections, DatabaseError
+
+from accounting.importers import parse_files
+from accounting.models import CSVInvoice
+
+def claim_files(limit):
+    """Marks the oldest pending files as running and returns them. The
+    conditional update lets more workers share the queue safely"""
+    claimed = []
+    pending = CSVInvoice.objects.filter(status='P').order_by('date', 'id')
+    for instance in pending[:limit]:
+        if CSVInvoice.objects.filter(id=instance.id, status='P').update(
+            status='R'):
+            instance.status = 'R'
+            claimed.append(instance)
+    return claimed
+
+def process_pending(limit=100):
+    """Parses pending files until the queue is empty, returns how many"""
+    count = 0
+    while True:
+        instances = claim_files(limit)
+        if not instances:
+            return count
+        #XML files of the batch are extracted in parallel
+        parse_files(instances)
+        count += len(instances)
+
+class Command(BaseCommand):
+    help = 'Parses CSV / XML files queued by uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+            help='Empty the queue and exit')
+        parser.add_argument('--sleep', type=float, default=2,
+            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--requeue', action='store_true',
+            help='Queue again files left running by a stopped worker')
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            CSVInvoice.objects.filter(status='R').update(status='P')
+        while True:
+            #as between requests, drops broken or old database connections.
+            #Never inside a transaction (i.e. tests)
+            if not connection.in_atomic_block:
+                close_old_connections()
+            try:
+                count = process_pending()
+            except DatabaseError as e:
+                if options['once']:
+                    raise
+                #the connection is replaced next round, files left running
+                #can be queued again with --requeue
+                self.stderr.write(f'Database error: {e}')
+                count = 0
+            if count:
+                self.stdout.write(f'Parsed {count} file(s)')
+            if options['once']:
+                return
+            time.sleep(options['sleep'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from accounting.rollups import rebuild
+from accounting.models import InvoiceRollup
+
+class Command(BaseCommand):
+    help = 'Recomputes monthly invoice rollups from scratch'
+
+    def handle(self, *args, **options):
+        rebuild()
+        self.stdout.write(f'{InvoiceRollup.objects.count()} rollup rows')
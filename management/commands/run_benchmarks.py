@@ -0,0 +1,86 @@
+import json
+import subprocess
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (setup_test_environment,
+    teardown_test_environment, override_settings)
+
+from accounting.benchmarks.amounts import bench_amounts
+from accounting.benchmarks.classifier import bench_classifier
+from accounting.benchmarks.suite import BENCHMARKS, run_suite, compare
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+class Command(BaseCommand):
+    help = 'Runs accounting benchmarks on a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cells', type=int, default=1000000,
+            help='Cells for the amount parsing benchmark')
+        parser.add_argument('--rules', type=int, default=400,
+            help='Category rules for the classifier benchmark')
+        parser.add_argument('--size', type=int, default=1000,
+            help='Invoices generated for the suite')
+        parser.add_argument('--per-file', type=int, default=100,
+            help='Invoices in each generated FatturaPA file')
+        parser.add_argument('--only', nargs='+',
+            choices=['amounts', 'classifier'] + list(BENCHMARKS),
+            help='Benchmarks to run, all by default')
+        parser.add_argument('--output', help='Writes results to a JSON file')
+        parser.add_argument('--compare',
+            help='JSON file of an earlier run, fails if something regressed')
+        parser.add_argument('--threshold', type=float, default=1.2,
+            help='Tolerated time and memory growth when comparing')
+
+    def handle(self, *args, **options):
+        only = options['only']
+        data = {'commit': get_commit()}
+        if not only or 'amounts' in only:
+            data['amounts'] = bench_amounts(options['cells'])
+            for key, value in data['amounts'].items():
+                self.stdout.write(f'{key}: {value}')
+        if not only or 'classifier' in only:
+            data['classifier'] = bench_classifier(options['rules'])
+            for key, value in data['classifier'].items():
+                self.stdout.write(f'classifier {key}: {value}')
+        names = [name for name in only or BENCHMARKS
+            if name not in ('amounts', 'classifier')]
+        if names:
+            data.update(self.run_suite(names, options))
+            for name, result in data['results'].items():
+                self.stdout.write(f"{name}: {result['wall']} s, "
+                    f"{result['queries']} queries, {result['peak_kb']} KB")
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+        if options['compare'] and 'results' in data:
+            with open(options['compare']) as f:
+                old = json.load(f)
+            lines, regressed = compare(old, data, options['threshold'])
+            for line in lines:
+                self.stdout.write(line)
+            if regressed:
+                raise CommandError('Benchmarks regressed')
+
+    def run_suite(self, names, options):
+        """Never touches the real database, media or cache"""
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0,
+            autoclobber=True, serialize=False)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                with override_settings(MEDIA_ROOT=directory, CACHES={
+                    'default': {'BACKEND':
+                    'django.core.cache.backends.locmem.LocMemCache'}}):
+                    return run_suite(directory, options['size'], names,
+                        options['per_file'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvinvoice',
+            name='job',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='csvinvoice',
+            name='status',
+            field=models.CharField(choices=[('P', 'In attesa'), ('R', 'In corso'), ('D', 'Completato')], default='D', editable=False, max_length=1, verbose_name='Stato'),
+        ),
+    ]
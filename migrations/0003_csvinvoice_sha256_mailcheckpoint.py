@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0002_csvinvoice_job_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvinvoice',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.CreateModel(
+            name='MailCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mailbox', models.CharField(max_length=200, unique=True, verbose_name='Casella')),
+                ('uid_validity', models.CharField(blank=True, max_length=50)),
+                ('last_uid', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Checkpoint posta',
+                'verbose_name_plural': 'Checkpoint posta',
+            },
+        ),
+    ]
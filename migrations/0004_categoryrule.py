@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+#keywords that used to be hardcoded in CSVInvoice.guess_*_category, in
+#priority order
+RULES = [
+    ('P01AU', ['renault', 'dacia', 'telepass', 'q8', 'autostrade', 'kuwait',
+        'auto']),
+    ('P04TE', ['fastweb', 'telecom', 'wind']),
+    ('P05CO', ['braghetta', 'petocchi', 'giordanella']),
+    ('P02AT', ['xerox', 'adrastea', 'grenke']),
+    ('P14SE', ['progesoft', 'geoweb', 'istedil', 'aruba', 'unisapiens']),
+    ('P03CA', ['ufficio moderno']),
+    ('A01PR', ['progetto', 'progettazione', 'fattibilità']),
+    ('A02DL', ['dl', 'direzione lavori', 'collaudo']),
+    ('A03CT', ['catasto', 'catastale']),
+    ('A04PE', ['perizia', 'relazione', 'consulenza']),
+    ]
+
+def create_rules(apps, schema_editor):
+    CategoryRule = apps.get_model('accounting', 'CategoryRule')
+    rules = []
+    for i, (category, keywords) in enumerate(RULES):
+        for keyword in keywords:
+            rules.append(CategoryRule(keyword=keyword, category=category,
+                priority=(i + 1) * 10))
+    CategoryRule.objects.bulk_create(rules)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0003_csvinvoice_sha256_mailcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('keyword', models.CharField(help_text='Cercata nella causale delle fatture attive e nel fornitore di quelle passive, senza distinguere maiuscole', max_length=100, verbose_name='Parola chiave')),
+                ('category', models.CharField(choices=[('A01PR', 'A-Progettazione architettonica'), ('A02DL', 'A-Direzione lavori'), ('A03CT', 'A-Catasto'), ('A04PE', 'A-Perizie'), ('A05AN', 'A-Anticipazioni'), ('A00', 'A-Varie'), ('X', 'Altro'), ('P05CO', 'P-Collaboratori'), ('P01AU', 'P-Automobili'), ('P02AT', 'P-Attrezzature'), ('P14SE', 'P-Servizi'), ('P13FO', 'P-Formazione'), ('P03CA', 'P-Cancelleria'), ('P04TE', 'P-Telefoni'), ('P11ER', 'P-Erogazioni'), ('P12AF', 'P-Affitti'), ('P07AS', 'P-Assicurazioni'), ('P09PR', 'P-Contributi'), ('P10TA', 'P-Tasse'), ('P06RE', 'P-Restituzioni'), ('P08DI', 'P-Dividendi'), ('P00', 'P-Varie')], help_text="'A' per attiva e 'P' per passiva.", max_length=5, verbose_name='Categoria')),
+                ('priority', models.PositiveIntegerField(default=100, help_text='Se si trovano più parole chiave vince la priorità più bassa', verbose_name='Priorità')),
+            ],
+            options={
+                'verbose_name': 'Regola di categoria',
+                'verbose_name_plural': 'Regole di categoria',
+                'ordering': ('priority', 'id'),
+            },
+        ),
+        migrations.RunPython(create_rules, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0004_categoryrule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='csvinvoice',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='accounting.csvinvoice', verbose_name='Duplicato di'),
+        ),
+    ]
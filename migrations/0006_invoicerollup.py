@@ -0,0 +1,65 @@
+from django.db import migrations, models
+from django.db.models import Sum, Count, Q, F, DecimalField, Value
+from django.db.models.functions import ExtractYear, ExtractMonth, Coalesce
+
+def create_rollups(apps, schema_editor):
+    Invoice = apps.get_model('accounting', 'Invoice')
+    InvoiceRollup = apps.get_model('accounting', 'InvoiceRollup')
+    money = DecimalField(max_digits=12, decimal_places=2)
+    total = F('amount') + F('security') + F('vat')
+    rows = (Invoice.objects.order_by().annotate(year=ExtractYear('date'),
+        month=ExtractMonth('date')).values('year', 'month', 'active',
+        'category').annotate(
+        amount_sum=Sum('amount', output_field=money),
+        security_sum=Sum('security', output_field=money),
+        vat_sum=Sum('vat', output_field=money),
+        total_sum=Sum(total, output_field=money),
+        count_sum=Count('id'),
+        paid_total=Coalesce(Sum(total, filter=Q(paid=True),
+            output_field=money), Value(0, output_field=money)),
+        paid_count=Count('id', filter=Q(paid=True)),
+        ))
+    InvoiceRollup.objects.bulk_create([InvoiceRollup(year=r['year'],
+        month=r['month'], active=r['active'], category=r['category'],
+        amount=r['amount_sum'], security=r['security_sum'], vat=r['vat_sum'],
+        total=r['total_sum'], count=r['count_sum'],
+        paid_total=r['paid_total'], paid_count=r['paid_count'])
+        for r in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0005_csvinvoice_duplicate_of'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(verbose_name='Anno')),
+                ('month', models.PositiveSmallIntegerField(verbose_name='Mese')),
+                ('active', models.BooleanField(verbose_name='Attiva')),
+                ('category', models.CharField(choices=[('A01PR', 'A-Progettazione architettonica'), ('A02DL', 'A-Direzione lavori'), ('A03CT', 'A-Catasto'), ('A04PE', 'A-Perizie'), ('A05AN', 'A-Anticipazioni'), ('A00', 'A-Varie'), ('X', 'Altro'), ('P05CO', 'P-Collaboratori'), ('P01AU', 'P-Automobili'), ('P02AT', 'P-Attrezzature'), ('P14SE', 'P-Servizi'), ('P13FO', 'P-Formazione'), ('P03CA', 'P-Cancelleria'), ('P04TE', 'P-Telefoni'), ('P11ER', 'P-Erogazioni'), ('P12AF', 'P-Affitti'), ('P07AS', 'P-Assicurazioni'), ('P09PR', 'P-Contributi'), ('P10TA', 'P-Tasse'), ('P06RE', 'P-Restituzioni'), ('P08DI', 'P-Dividendi'), ('P00', 'P-Varie')], max_length=5, verbose_name='Categoria')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Imponibile')),
+                ('security', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Contributi')),
+                ('vat', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='IVA')),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Importo')),
+                ('count', models.PositiveIntegerField(verbose_name='Fatture')),
+                ('paid_total', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Saldata')),
+                ('paid_count', models.PositiveIntegerField(verbose_name='Fatture saldate')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Riepilogo fatture',
+                'verbose_name_plural': 'Riepiloghi fatture',
+                'ordering': ('year', 'month', 'active', 'category'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='invoicerollup',
+            constraint=models.UniqueConstraint(fields=('year', 'month', 'active', 'category'), name='unique_invoice_rollup'),
+        ),
+        migrations.RunPython(create_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+def check_duplicates(apps, schema_editor):
+    """Leaves fixing to the user, rather than dropping invoices"""
+    Invoice = apps.get_model('accounting', 'Invoice')
+    duplicates = list(Invoice.objects.order_by().values('number',
+        'date').annotate(n=Count('id')).filter(n__gt=1)[:10])
+    if duplicates:
+        raise ValueError('Invoices sharing number and date, delete or '
+            'change them before migrating: ' + ', '.join(
+            f"{d['number']} {d['date']}" for d in duplicates))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0006_invoicerollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='invoice',
+            constraint=models.UniqueConstraint(fields=('number', 'date'), name='unique_invoice_number_date'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['date', 'id'], name='invoice_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['date', 'active', 'category'], name='invoice_date_active_cat_idx'),
+        ),
+    ]
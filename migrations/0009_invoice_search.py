@@ -0,0 +1,68 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+#sqlite drops triggers when it remakes the invoice table, later migrations
+#altering it should run create_index again. The accounting.E001 check
+#(search.check_fts_triggers) fails until they do
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE accounting_invoice_fts USING fts5(client, descr, "
+    "content='accounting_invoice', content_rowid='id')",
+    "CREATE TRIGGER accounting_invoice_fts_insert AFTER INSERT ON "
+    "accounting_invoice BEGIN INSERT INTO accounting_invoice_fts(rowid, "
+    "client, descr) VALUES (new.id, new.client, new.descr); END",
+    "CREATE TRIGGER accounting_invoice_fts_delete AFTER DELETE ON "
+    "accounting_invoice BEGIN INSERT INTO accounting_invoice_fts("
+    "accounting_invoice_fts, rowid, client, descr) VALUES ('delete', "
+    "old.id, old.client, old.descr); END",
+    "CREATE TRIGGER accounting_invoice_fts_update AFTER UPDATE OF client, "
+    "descr ON accounting_invoice BEGIN INSERT INTO accounting_invoice_fts("
+    "accounting_invoice_fts, rowid, client, descr) VALUES ('delete', "
+    "old.id, old.client, old.descr); INSERT INTO accounting_invoice_fts("
+    "rowid, client, descr) VALUES (new.id, new.client, new.descr); END",
+    "INSERT INTO accounting_invoice_fts(accounting_invoice_fts) "
+    "VALUES ('rebuild')",
+    ]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS accounting_invoice_fts_insert",
+    "DROP TRIGGER IF EXISTS accounting_invoice_fts_delete",
+    "DROP TRIGGER IF EXISTS accounting_invoice_fts_update",
+    "DROP TABLE IF EXISTS accounting_invoice_fts",
+    ]
+POSTGRESQL_CREATE = [
+    "CREATE INDEX invoice_search_idx ON accounting_invoice USING GIN "
+    "(to_tsvector('simple', coalesce(client, '') || ' ' || "
+    "coalesce(descr, '')))",
+    ]
+POSTGRESQL_DROP = ["DROP INDEX IF EXISTS invoice_search_idx"]
+
+def create_index(apps, schema_editor):
+    """Search falls back to icontains where this creates nothing"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        drop_index(apps, schema_editor)
+        try:
+            for sql in SQLITE_CREATE:
+                schema_editor.execute(sql)
+        except OperationalError:
+            #sqlite built without FTS5
+            drop_index(apps, schema_editor)
+    elif vendor == 'postgresql':
+        for sql in POSTGRESQL_CREATE:
+            schema_editor.execute(sql)
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for sql in {'sqlite': SQLITE_DROP,
+        'postgresql': POSTGRESQL_DROP}.get(vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0008_invoice_unpaid_active_date_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
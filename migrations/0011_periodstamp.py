@@ -0,0 +1,39 @@
+from django.db import migrations, models
+from django.db.models import Max
+
+def create_stamps(apps, schema_editor):
+    InvoiceRollup = apps.get_model('accounting', 'InvoiceRollup')
+    PeriodStamp = apps.get_model('accounting', 'PeriodStamp')
+    rows = (InvoiceRollup.objects.order_by().values('year', 'month')
+        .annotate(last=Max('updated')))
+    PeriodStamp.objects.bulk_create([PeriodStamp(year=r['year'],
+        month=r['month'], updated=r['last']) for r in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0010_invoice_unpaid_date_active_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodStamp',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(verbose_name='Year')),
+                ('month', models.PositiveSmallIntegerField(verbose_name='Month')),
+                ('updated', models.DateTimeField(verbose_name='Updated')),
+            ],
+            options={
+                'verbose_name': 'Period stamp',
+                'verbose_name_plural': 'Period stamps',
+                'ordering': ('year', 'month'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='periodstamp',
+            constraint=models.UniqueConstraint(fields=('year', 'month'), name='unique_period_stamp'),
+        ),
+        migrations.RunPython(create_stamps, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,16 @@
 import csv
+import hashlib
 import os
 from datetime import datetime, date
-import xml.etree.ElementTree as ET
 
-from django.db import models
+from django.db import models, transaction, DatabaseError
+from django.db.models import Q
 from django.utils.timezone import now
 from django.core.validators import FileExtensionValidator
 from django.utils.translation import gettext as _
 
-from .choices import CAT
+from .choices import CAT, STATUS
+from .instrumentation import measure_import
 
 class Invoice(models.Model):
     number = models.CharField(_('Number'), max_length = 50, )
@@ -34,10 +36,27 @@ class Invoice(models.Model):
         return self.amount + self.security + self.vat
     get_total.short_description = _('Amount')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Invoice, cls).from_db(db, field_names, values)
+        #if date changes, rollups of the old period need a refresh too
+        instance._loaded_date = instance.__dict__.get('date')
+        return instance
+
     class Meta:
         verbose_name = _('Invoice')
         verbose_name_plural = _('Invoices')
         ordering = ('-date', )
+        constraints = [models.UniqueConstraint(fields=['number', 'date'],
+            name='unique_invoice_number_date')]
+        #archive pages and keyset pagination, rollup aggregation, then
+        #aging. Boolean lookups are bare columns on sqlite, which only
+        #match a partial index
+        indexes = [models.Index(fields=['date', 'id'],
+            name='invoice_date_id_idx'), models.Index(fields=['date',
+            'active', 'category'], name='invoice_date_active_cat_idx'),
+            models.Index(fields=['date', 'active'], condition=Q(paid=False),
+            name='invoice_unpaid_date_active_idx')]
 
 class CSVInvoice(models.Model):
     date = models.DateTimeField(_('Date'), default = now, )
@@ -47,6 +66,15 @@ class CSVInvoice(models.Model):
     created = models.IntegerField(default=0, editable=False)
     modified = models.IntegerField(default=0, editable=False)
     failed = models.IntegerField(default=0, editable=False)
+    status = models.CharField(_('Status'), max_length = 1, choices = STATUS,
+        default = 'D', editable=False, )
+    job = models.UUIDField(null=True, blank=True, editable=False,
+        db_index=True, )
+    sha256 = models.CharField(max_length = 64, blank=True, editable=False,
+        db_index=True, )
+    duplicate_of = models.ForeignKey('self', on_delete = models.SET_NULL,
+        null=True, blank=True, editable=False,
+        verbose_name = _('Duplicate of'), )
 
     def prepare_float(self, value):
         if value:
@@ -57,150 +85,114 @@ class CSVInvoice(models.Model):
             value = '0'
         return float(value)
 
+    def csv_records(self, upserter):
+        """Streams records from the CSV file, counting rows that fail"""
+        with open(self.csv.path, newline='', encoding='latin-1') as csvfile:
+            reader = csv.reader(csvfile)
+            for row in reader:
+                #this exception catches input anomalies
+                try:
+                    record = {
+                        'number': row[0],
+                        'date': datetime.strptime(row[3], '%d/%m/%y').date(),
+                        'client': row[1],
+                        'active': bool(row[2]),
+                        'descr': row[4],
+                        #converted by chunks, see importers.convert_amounts
+                        'amount': row[5],
+                        'security': row[6],
+                        'vat': row[7],
+                        'category': row[8],
+                        'paid': bool(row[9])
+                        }
+                except: #single row fails
+                    if not row[3] == 'gg/mm/aa':#means it's not header
+                        upserter.failed += 1
+                    continue
+                yield record
+
+    def save_counters(self, counters):
+        self.created = counters.created
+        self.modified = counters.modified
+        self.failed = counters.failed
+        super(CSVInvoice, self).save(update_fields=['created', 'modified',
+            'failed'])
+
     def parse_csv(self):
+        from . import importers
+        upserter = importers.InvoiceUpserter()
+        #counters of the chunks committed so far
+        written = importers.Counters()
         #this exception catches file anomalies
         try:
-            with open(self.csv.path, newline='', encoding='latin-1') as csvfile:
-                reader = csv.reader(csvfile)
-                for row in reader:
-                    #this exception catches input anomalies
-                    try:
-                        obj, created = Invoice.objects.update_or_create(
-                            number = row[0],
-                            date = datetime.strptime(row[3], '%d/%m/%y'),
-                            defaults = {
-                                'client': row[1],
-                                'active': bool(row[2]),
-                                'descr': row[4],
-                                'amount': self.prepare_float(row[5]),
-                                'security': self.prepare_float(row[6]),
-                                'vat': self.prepare_float(row[7]),
-                                'category': row[8],
-                                'paid': bool(row[9])
-                                }
-                            )
-                        if created:
-                            self.created += 1
-                        else:
-                            self.modified += 1
-                    except: #single row fails
-                        if not row[3] == 'gg/mm/aa':#means it's not header
-                            self.failed += 1
-        except: #all document fails
-            self.created = 0
-            self.modified = 0
-            self.failed = 1
-        super(CSVInvoice, self).save(update_fields=['created', 'modified',
-            'failed'])
+            #each chunk is committed together with the running counters,
+            #so a long import can be watched and a crash leaves exact counts
+            for records in importers.chunked(self.csv_records(upserter),
+                importers.CHUNK_SIZE):
+                records = importers.convert_amounts(records, upserter)
+                with transaction.atomic():
+                    upserter.upsert(records)
+                    self.save_counters(upserter)
+                written.created = upserter.created
+                written.modified = upserter.modified
+                written.failed = upserter.failed
+            self.save_counters(upserter)
+        except Exception as e:
+            #rest of the document fails, committed chunks are there
+            written.failed += 1
+            self.save_counters(written)
+            #not an anomaly of the file, left to the caller
+            if isinstance(e, DatabaseError):
+                raise
 
     def guess_passive_category(self, string):
-        low = string.lower()
-        auto = ['renault', 'dacia', 'telepass', 'q8', 'autostrade', 'kuwait', 'auto']
-        tel = ['fastweb', 'telecom', 'wind']
-        coll = ['braghetta', 'petocchi', 'giordanella']
-        attr = ['xerox', 'adrastea', 'grenke']
-        serv = ['progesoft', 'geoweb', 'istedil', 'aruba', 'unisapiens']
-        cart = ['ufficio moderno']
-        if any(x in low for x in auto):
-            return 'P01AU'
-        elif any(x in low for x in tel):
-            return 'P04TE'
-        elif any(x in low for x in coll):
-            return 'P05CO'
-        elif any(x in low for x in attr):
-            return 'P02AT'
-        elif any(x in low for x in serv):
-            return 'P14SE'
-        elif any(x in low for x in cart):
-            return 'P03CA'
-        return 'P00'
+        from .classifier import get_classifier
+        return get_classifier().passive.guess(string)
 
     def guess_active_category(self, string):
-        low = string.lower()
-        prog = ['progetto', 'progettazione', 'fattibilità']
-        dl = ['dl', 'direzione lavori', 'collaudo']
-        cat = ['catasto', 'catastale']
-        per = ['perizia', 'relazione', 'consulenza']
-        if any(x in low for x in prog):
-            return 'A01PR'
-        elif any(x in low for x in dl):
-            return 'A02DL'
-        elif any(x in low for x in cat):
-            return 'A03CT'
-        elif any(x in low for x in per):
-            return 'A04PE'
-        return 'A00'
+        from .classifier import get_classifier
+        return get_classifier().active.guess(string)
 
     def parse_xml(self):
-        #this exception catches file and input anomalies
-        try:
-            tree = ET.parse(self.csv.path)
-            root = tree.getroot()
-            cp = root.find('.//CedentePrestatore')
-            den = cp.find('.//Denominazione')
-            if ET.iselement(den) and den.text == 'Associazione Professionale Perilli':
-                active = True
-                cc = root.find('.//CessionarioCommittente')
-                if ET.iselement(cc.find('.//Denominazione')):
-                    client = cc.find('.//Denominazione').text
-                else:
-                    client = (cc.find('.//Nome').text + ' ' +
-                        cc.find('.//Cognome').text)
-            else:
-                active = False
-                if ET.iselement(den):
-                    client = den.text
-                else:
-                    client = (cp.find('.//Nome').text + ' ' +
-                        cp.find('.//Cognome').text)
-                category = self.guess_passive_category(client)
-            date = root.find('.//Data').text
-            number = root.find('.//Numero').text
-            security = 0
-            for sec in root.findall('.//ImportoContributoCassa'):
-                security += float(sec.text)
-            descr = ''
-            for dsc in root.findall('.//Descrizione'):
-                descr += dsc.text + '\n'
-            if active:
-                category = self.guess_active_category(descr)
-            amount = 0
-            for amnt in root.findall('.//PrezzoTotale'):
-                amount += float(amnt.text)
-            vat = root.find('.//Imposta').text
-            obj, created = Invoice.objects.update_or_create(
-                number = number,
-                date = datetime.strptime(date, '%Y-%m-%d'),
-                defaults = {
-                    'client': client,
-                    'active': active,
-                    'descr': descr,
-                    'amount': amount,
-                    'security': security,
-                    'vat': float(vat),
-                    'category': category,
-                    'paid': False
-                    }
-                )
-            if created:
-                self.created += 1
-            else:
-                self.modified += 1
-        except:
-            self.failed += 1
-        super(CSVInvoice, self).save(update_fields=['created', 'modified',
-            'failed'])
+        from .importers import import_xml_files
+        #anomalies of the file are counted by import_xml_files, which saves
+        #counters and raises again anything else
+        import_xml_files([self], max_workers=1)
+
+    def parse(self):
+        ext = self.get_filename().split('.')[1].lower()
+        with measure_import(ext, [self]):
+            if ext == 'csv':
+                self.parse_csv()
+            elif ext == 'xml':
+                self.parse_xml()
+
+    def get_sha256(self):
+        sha = hashlib.sha256()
+        for chunk in self.csv.chunks():
+            sha.update(chunk)
+        return sha.hexdigest()
 
     def save(self, *args, **kwargs):
         self.created = 0
         self.modified = 0
         self.failed = 0
+        if not self.csv._committed:
+            #new upload, content already imported is neither stored nor parsed
+            self.sha256 = self.get_sha256()
+            original = CSVInvoice.objects.filter(sha256=self.sha256,
+                duplicate_of=None).exclude(id=self.id).first()
+            if original:
+                self.csv = original.csv.name
+                self.duplicate_of = original
+                self.status = 'D'
+                super(CSVInvoice, self).save(*args, **kwargs)
+                return
         super(CSVInvoice, self).save(*args, **kwargs)
-        ext = self.get_filename().split('.')[1].lower()
-        if ext == 'csv':
-            self.parse_csv()
-        elif ext == 'xml':
-            self.parse_xml()
+        if self.status != 'D':
+            #queued or parsed by the caller (see importers.parse_files)
+            return
+        self.parse()
 
     def get_filename(self):
         return os.path.basename(self.csv.name)
@@ -213,3 +205,87 @@ class CSVInvoice(models.Model):
         verbose_name = _('CSV/XML file')
         verbose_name_plural = _('CSV/XML files')
         ordering = ('-date', )
+
+class MailCheckpoint(models.Model):
+    """Highest IMAP UID fetched from a mailbox, valid while the mailbox
+    keeps the same UIDVALIDITY"""
+    mailbox = models.CharField(_('Mailbox'), max_length = 200, unique=True, )
+    uid_validity = models.CharField(max_length = 50, blank=True, )
+    last_uid = models.PositiveIntegerField(default=0, )
+
+    def __str__(self):
+        return self.mailbox
+
+    class Meta:
+        verbose_name = _('Mail checkpoint')
+        verbose_name_plural = _('Mail checkpoints')
+
+class CategoryRule(models.Model):
+    keyword = models.CharField(_('Keyword'), max_length = 100,
+        help_text = _("""Looked for in the description of active invoices
+            and in the supplier of passive ones, case insensitive"""))
+    category = models.CharField(_('Category'), max_length = 5, choices = CAT,
+        help_text = _("""'A' for active and 'P' for passive."""))
+    priority = models.PositiveIntegerField(_('Priority'), default = 100,
+        help_text = _("""If more keywords are found, lowest priority wins"""))
+
+    def __str__(self):
+        return self.keyword
+
+    class Meta:
+        verbose_name = _('Category rule')
+        verbose_name_plural = _('Category rules')
+        ordering = ('priority', 'id', )
+
+class InvoiceRollup(models.Model):
+    """Invoice totals by month, active and category, kept up to date by
+    rollups.refresh_periods"""
+    year = models.PositiveSmallIntegerField(_('Year'), )
+    month = models.PositiveSmallIntegerField(_('Month'), )
+    active = models.BooleanField(_('Active'), )
+    category = models.CharField(_('Category'), max_length = 5, choices = CAT, )
+    amount = models.DecimalField(_('Taxable'), max_digits=12,
+        decimal_places=2)
+    security = models.DecimalField(_('Social security'), max_digits=12,
+        decimal_places=2)
+    vat = models.DecimalField(_('VAT'), max_digits=12, decimal_places=2)
+    total = models.DecimalField(_('Amount'), max_digits=12, decimal_places=2)
+    count = models.PositiveIntegerField(_('Invoices'), )
+    paid_total = models.DecimalField(_('Paid'), max_digits=12,
+        decimal_places=2)
+    paid_count = models.PositiveIntegerField(_('Paid invoices'), )
+    updated = models.DateTimeField(auto_now=True, )
+
+    def get_unpaid_total(self):
+        return self.total - self.paid_total
+
+    def get_unpaid_count(self):
+        return self.count - self.paid_count
+
+    def __str__(self):
+        return f'{self.year}-{self.month:02d} {self.category}'
+
+    class Meta:
+        verbose_name = _('Invoice rollup')
+        verbose_name_plural = _('Invoice rollups')
+        ordering = ('year', 'month', 'active', 'category', )
+        constraints = [models.UniqueConstraint(fields=['year', 'month',
+            'active', 'category'], name='unique_invoice_rollup')]
+
+class PeriodStamp(models.Model):
+    """Last change of the invoices of a month, set by
+    rollups.refresh_periods. Kept when the month is left without invoices,
+    so that it never goes back"""
+    year = models.PositiveSmallIntegerField(_('Year'), )
+    month = models.PositiveSmallIntegerField(_('Month'), )
+    updated = models.DateTimeField(_('Updated'), )
+
+    def __str__(self):
+        return f'{self.year}-{self.month:02d}'
+
+    class Meta:
+        verbose_name = _('Period stamp')
+        verbose_name_plural = _('Period stamps')
+        ordering = ('year', 'month', )
+        constraints = [models.UniqueConstraint(fields=['year', 'month'],
+            name='unique_period_stamp')]
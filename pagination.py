@@ -0,0 +1,98 @@
+import base64
+from datetime import date
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.translation import gettext as _
+
+#cursors point after (next) or before (previous) a (date, id) row, the
+#list being ordered by descending date and id
+NEXT = 'n'
+PREVIOUS = 'p'
+
+def encode_cursor(direction, obj):
+    value = f'{direction}|{obj.date.isoformat()}|{obj.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """(direction, date, id) of a cursor, Http404 if it's broken"""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, day, id = value.decode().split('|')
+        if direction not in (NEXT, PREVIOUS):
+            raise ValueError
+        return (direction, date.fromisoformat(day), int(id))
+    except ValueError:
+        raise Http404(_("Invalid cursor"))
+
+def after(day, id):
+    return Q(date__lt=day) | Q(date=day, id__lt=id)
+
+def before(day, id):
+    return Q(date__gt=day) | Q(date=day, id__gt=id)
+
+class KeysetPage:
+    """Quacks like a Page of the template, without page numbers"""
+
+    def __init__(self, object_list, next_cursor, previous_cursor,
+        skipped=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        #rows before this page, only if asked for as it needs a COUNT
+        self.skipped = skipped
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+class KeysetPaginator:
+    """Seeks pages of invoices on (date, id), so that any page costs as
+    much as the first one and no COUNT is needed"""
+
+    def __init__(self, queryset, per_page, count_skipped=False):
+        self.queryset = queryset.order_by('-date', '-id')
+        self.per_page = per_page
+        self.count_skipped = count_skipped
+
+    def page(self, cursor=None):
+        if cursor:
+            direction, day, id = decode_cursor(cursor)
+        else:
+            direction = None
+        #one more row tells whether there is a further page
+        if direction == PREVIOUS:
+            rows = list(self.queryset.filter(before(day, id)).order_by(
+                'date', 'id')[:self.per_page + 1])
+            more_before = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            more_after = True
+        else:
+            qs = self.queryset
+            if direction == NEXT:
+                qs = qs.filter(after(day, id))
+            rows = list(qs[:self.per_page + 1])
+            more_after = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            more_before = direction == NEXT
+        if not rows:
+            return KeysetPage(rows, None, None)
+        skipped = None
+        if self.count_skipped:
+            skipped = self.queryset.filter(before(rows[0].date,
+                rows[0].id)).count()
+        return KeysetPage(rows,
+            encode_cursor(NEXT, rows[-1]) if more_after else None,
+            encode_cursor(PREVIOUS, rows[0]) if more_before else None,
+            skipped)
@@ -0,0 +1,82 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Sum, Q, F, Count, DecimalField, Value
+from django.db.models.functions import TruncMonth, TruncQuarter, Coalesce
+
+from .models import Invoice
+
+TRUNCATE = {'month': TruncMonth, 'quarter': TruncQuarter}
+ZERO = Decimal('0.00')
+#label, first and last day of each aging bucket
+AGING_BUCKETS = (('0-30', 0, 30), ('31-60', 31, 60), ('61-90', 61, 90),
+    ('90+', 91, None))
+
+def get_period_label(day, period):
+    if period == 'quarter':
+        return f'{day.year}-Q{(day.month - 1) // 3 + 1}'
+    return f'{day.year}-{day.month:02d}'
+
+def vat_liquidation(start, end, period='month'):
+    """VAT of active invoices less VAT of passive ones for each month or
+    quarter from start to end (both included), in one grouped query.
+    Periods without invoices are left out"""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    zero = Value(0, output_field=money)
+    rows = (Invoice.objects.filter(date__gte=start, date__lte=end).order_by()
+        .annotate(period=TRUNCATE[period]('date')).values('period')
+        .annotate(
+        active_vat=Coalesce(Sum('vat', filter=Q(active=True),
+            output_field=money), zero),
+        passive_vat=Coalesce(Sum('vat', filter=Q(active=False),
+            output_field=money), zero),
+        ).order_by('period'))
+    report = {'start': start, 'end': end, 'period': period, 'rows': [],
+        'active_vat': ZERO, 'passive_vat': ZERO, 'balance': ZERO}
+    for row in rows:
+        #sqlite drops decimal places from sums
+        active = Decimal(row['active_vat']).quantize(ZERO)
+        passive = Decimal(row['passive_vat']).quantize(ZERO)
+        report['rows'].append({'period': get_period_label(row['period'],
+            period), 'active_vat': active, 'passive_vat': passive,
+            'balance': active - passive})
+        report['active_vat'] += active
+        report['passive_vat'] += passive
+        report['balance'] += active - passive
+    return report
+
+def get_bucket_filter(day, first, last):
+    """Invoices dated from last to first days before day"""
+    q = Q(date__lte=day - timedelta(days=first))
+    if last is not None:
+        q &= Q(date__gte=day - timedelta(days=last))
+    return q
+
+def aging(day):
+    """Totals of unpaid invoices by age at day, per client and bucket, for
+    receivables (active) and payables (passive), in one grouped query.
+    Invoices dated after day are left out"""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    zero = Value(0, output_field=money)
+    total = F('amount') + F('security') + F('vat')
+    rows = (Invoice.objects.filter(paid=False, date__lte=day).order_by()
+        .values('active', 'client').annotate(count=Count('id'), **{
+        f'bucket_{i}': Coalesce(Sum(total, filter=get_bucket_filter(day,
+            first, last), output_field=money), zero)
+        for i, (label, first, last) in enumerate(AGING_BUCKETS)})
+        .order_by('-active', 'client'))
+    report = {'date': day, 'buckets': [b[0] for b in AGING_BUCKETS]}
+    for key in ('receivables', 'payables'):
+        report[key] = {'rows': [], 'count': 0, 'total': ZERO,
+            'buckets': [ZERO] * len(AGING_BUCKETS)}
+    for row in rows:
+        part = report['receivables' if row['active'] else 'payables']
+        #sqlite drops decimal places from sums
+        buckets = [Decimal(row[f'bucket_{i}']).quantize(ZERO)
+            for i in range(len(AGING_BUCKETS))]
+        part['rows'].append({'client': row['client'], 'count': row['count'],
+            'buckets': buckets, 'total': sum(buckets, ZERO)})
+        part['count'] += row['count']
+        part['total'] += sum(buckets, ZERO)
+        part['buckets'] = [a + b for a, b in zip(part['buckets'], buckets)]
+    return report
@@ -0,0 +1,146 @@
+from datetime import date
+
+from django.db import connection, transaction
+from django.db.models import Sum, Count, Q, F, DecimalField, Value
+from django.db.models.functions import ExtractYear, ExtractMonth, Coalesce
+from django.utils.timezone import now
+
+from .caching import invalidate_periods
+from .models import Invoice, InvoiceRollup, PeriodStamp
+
+GROUP_FIELDS = ['year', 'month', 'active', 'category']
+TOTAL_FIELDS = ['amount', 'security', 'vat', 'total', 'count', 'paid_total',
+    'paid_count', 'updated']
+#first key of PostgreSQL advisory locks on periods, the second is the period
+LOCK_CLASS = 4242
+
+def get_period(value):
+    """(year, month) of an Invoice date, even if not yet cleaned"""
+    value = Invoice._meta.get_field('date').to_python(value)
+    return (value.year, value.month)
+
+def get_period_filter(periods):
+    q = Q()
+    for year, month in periods:
+        following = date(year + month // 12, month % 12 + 1, 1)
+        q |= Q(date__gte=date(year, month, 1), date__lt=following)
+    return q
+
+def aggregate(qs):
+    """One grouped query, a row for each month, active and category"""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    zero = Value(0, output_field=money)
+    total = F('amount') + F('security') + F('vat')
+    return (qs.order_by().annotate(year=ExtractYear('date'),
+        month=ExtractMonth('date')).values('year', 'month', 'active',
+        'category').annotate(
+        amount_sum=Sum('amount', output_field=money),
+        security_sum=Sum('security', output_field=money),
+        vat_sum=Sum('vat', output_field=money),
+        total_sum=Sum(total, output_field=money),
+        count_sum=Count('id'),
+        paid_total=Coalesce(Sum(total, filter=Q(paid=True),
+            output_field=money), zero),
+        paid_count=Count('id', filter=Q(paid=True)),
+        ))
+
+def get_rollups(rows):
+    return [InvoiceRollup(year=r['year'], month=r['month'],
+        active=r['active'], category=r['category'], amount=r['amount_sum'],
+        security=r['security_sum'], vat=r['vat_sum'], total=r['total_sum'],
+        count=r['count_sum'], paid_total=r['paid_total'],
+        paid_count=r['paid_count']) for r in rows]
+
+def create_rollups(rows):
+    InvoiceRollup.objects.bulk_create(get_rollups(rows))
+
+def lock_periods(periods):
+    """Serializes refreshes of the same periods on PostgreSQL, until the
+    transaction ends. Totals are then computed after concurrent writers
+    commit, rather than from a snapshot missing their invoices"""
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for year, month in sorted(periods):
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                [LOCK_CLASS, year * 100 + month])
+
+def stamp_periods(periods):
+    """Sets the last change of the periods to now. Stamps are never
+    deleted, so Last-Modified of charts does not go back when a month is
+    left without invoices"""
+    updated = now()
+    stamps = [PeriodStamp(year=year, month=month, updated=updated)
+        for year, month in sorted(periods)]
+    features = connection.features
+    if not features.supports_update_conflicts:
+        for stamp in stamps:
+            PeriodStamp.objects.update_or_create(year=stamp.year,
+                month=stamp.month, defaults={'updated': stamp.updated})
+        return
+    PeriodStamp.objects.bulk_create(stamps, update_conflicts=True,
+        unique_fields=(['year', 'month'] if
+        features.supports_update_conflicts_with_target else None),
+        update_fields=['updated'])
+
+def refresh_periods(periods):
+    """Recomputes rollups of the given (year, month) periods. Rows are
+    upserted and only groups left without invoices deleted, so concurrent
+    refreshes of a period never insert the same row twice"""
+    periods = set(periods)
+    if not periods:
+        return
+    with transaction.atomic():
+        lock_periods(periods)
+        period_q = Q()
+        for year, month in periods:
+            period_q |= Q(year=year, month=month)
+        rollups = get_rollups(aggregate(Invoice.objects.filter(
+            get_period_filter(periods))))
+        features = connection.features
+        stamp_periods(periods)
+        if not features.supports_update_conflicts:
+            InvoiceRollup.objects.filter(period_q).delete()
+            InvoiceRollup.objects.bulk_create(rollups)
+            invalidate(periods)
+            return
+        keys = {(r.year, r.month, r.active, r.category) for r in rollups}
+        stale = [id for id, *key in InvoiceRollup.objects.filter(
+            period_q).values_list('id', *GROUP_FIELDS) if tuple(key) not in keys]
+        if stale:
+            InvoiceRollup.objects.filter(id__in=stale).delete()
+        #same order in every transaction, so row locks can't deadlock
+        rollups.sort(key=lambda r: (r.year, r.month, r.active, r.category))
+        InvoiceRollup.objects.bulk_create(rollups, update_conflicts=True,
+            unique_fields=(GROUP_FIELDS if
+            features.supports_update_conflicts_with_target else None),
+            update_fields=TOTAL_FIELDS)
+        invalidate(periods)
+
+def invalidate(periods, everything=False):
+    """Drops cached periods now and again on commit, in case a request
+    cached them from a snapshot taken before the commit"""
+    invalidate_periods(periods, everything)
+    transaction.on_commit(lambda: invalidate_periods(periods, everything))
+
+def rebuild():
+    with transaction.atomic():
+        InvoiceRollup.objects.all().delete()
+        create_rollups(aggregate(Invoice.objects.all()))
+        PeriodStamp.objects.update(updated=now())
+        stamp_periods(InvoiceRollup.objects.values_list('year',
+            'month').distinct())
+        invalidate([], True)
+
+def invoice_saved(sender, instance, **kwargs):
+    periods = {get_period(instance.date)}
+    if getattr(instance, '_loaded_date', None):
+        periods.add(get_period(instance._loaded_date))
+    refresh_periods(periods)
+    instance._loaded_date = instance.date
+
+def invoice_deleted(sender, instance, **kwargs):
+    periods = {get_period(instance.date)}
+    if getattr(instance, '_loaded_date', None):
+        periods.add(get_period(instance._loaded_date))
+    refresh_periods(periods)
@@ -0,0 +1,114 @@
+import re
+
+from django.core import checks
+from django.db import connection, connections
+from django.db.models import Q, BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import Invoice
+
+#full text index over client and descr, created by migration 0009: an FTS5
+#external content table kept in sync by triggers on sqlite, a GIN expression
+#index on PostgreSQL. Other databases, or sqlite without FTS5, fall back to
+#icontains
+FTS_TABLE = 'accounting_invoice_fts'
+TS_VECTOR = ("to_tsvector('simple', coalesce(client, '') || ' ' || "
+    "coalesce(descr, ''))")
+FTS_TRIGGERS = ('accounting_invoice_fts_insert',
+    'accounting_invoice_fts_delete', 'accounting_invoice_fts_update')
+_fts_tables = {}
+
+def get_terms(query):
+    """Words of the query, leaving out full text syntax"""
+    return re.findall(r'\w+', query)
+
+def has_fts_table():
+    """Whether migrations could create the FTS5 table, once per database"""
+    name = connection.settings_dict['NAME']
+    if name not in _fts_tables:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                "AND name=%s", [FTS_TABLE])
+            _fts_tables[name] = cursor.fetchone() is not None
+    return _fts_tables[name]
+
+def check_fts_triggers(app_configs=None, databases=None, **kwargs):
+    """Database check (run by migrate and check --database) that triggers
+    keeping the FTS5 table in sync are there. Sqlite drops them whenever a
+    migration remakes the invoice table"""
+    errors = []
+    for alias in databases or []:
+        if connections[alias].vendor != 'sqlite':
+            continue
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name IN "
+                "(%s, %s, %s, %s)", [FTS_TABLE, *FTS_TRIGGERS])
+            names = set(row[0] for row in cursor.fetchall())
+        if FTS_TABLE not in names:
+            #no FTS5, search falls back to icontains
+            continue
+        missing = [name for name in FTS_TRIGGERS if name not in names]
+        if missing:
+            errors.append(checks.Error('Full text search of invoices is no '
+                'longer kept in sync, triggers are missing: %s' % ', '.join(
+                missing), hint='Add a migration running create_index() of '
+                'accounting migration 0009 again, then apply it with migrate '
+                '--skip-checks', id='accounting.E001'))
+    return errors
+
+class FTSResults:
+    """Ranked matches of an FTS5 query, sliced and counted in sqlite, so
+    that Paginator fetches only the invoices of a page"""
+
+    def __init__(self, match):
+        self.match = match
+
+    def count(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {FTS_TABLE} WHERE '
+                f'{FTS_TABLE} MATCH %s', [self.match])
+            return cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start = key.start or 0
+        limit = -1 if key.stop is None else key.stop - start
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid, rank FROM {FTS_TABLE} WHERE '
+                f'{FTS_TABLE} MATCH %s ORDER BY rank, rowid DESC LIMIT %s '
+                'OFFSET %s', [self.match, limit, start])
+            ranks = cursor.fetchall()
+        invoices = Invoice.objects.in_bulk([id for id, rank in ranks])
+        results = []
+        for id, rank in ranks:
+            #the table may be stale if triggers are gone, see check above
+            if id not in invoices:
+                continue
+            #bm25 is negative, better matches lower
+            invoices[id].rank = -rank
+            results.append(invoices[id])
+        return results
+
+def search_invoices(query):
+    """Invoices matching all words of the query as prefixes, best first.
+    Returns a queryset, or FTSResults on sqlite, for Paginator"""
+    terms = get_terms(query)
+    if not terms:
+        return Invoice.objects.none()
+    if connection.vendor == 'sqlite' and has_fts_table():
+        return FTSResults(' '.join(f'"{term}"*' for term in terms))
+    if connection.vendor == 'postgresql':
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        return Invoice.objects.filter(RawSQL(f"{TS_VECTOR} @@ "
+            "to_tsquery('simple', %s)", [tsquery],
+            output_field=BooleanField())).annotate(rank=RawSQL(
+            f"ts_rank({TS_VECTOR}, to_tsquery('simple', %s))", [tsquery],
+            output_field=FloatField())).order_by('-rank', '-id')
+    qs = Invoice.objects.all()
+    for term in terms:
+        qs = qs.filter(Q(client__icontains=term) | Q(descr__icontains=term))
+    return qs.order_by('-date', '-id')
@@ -0,0 +1,209 @@
+import os
+import uuid
+from datetime import date, timedelta
+from io import StringIO
+from math import ceil
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from users.models import User
+from accounting.importers import CHUNK_SIZE
+from accounting.models import Invoice, CSVInvoice
+from accounting import search
+from accounting.rollups import rebuild
+from accounting.urls.invoices import urlpatterns
+
+#invoices in the database while endpoints are measured, counts must not
+#change from one size to the next
+SIZES = (10, 1000, 10000)
+#url name, kwargs and most queries allowed, login included. Kwargs that are
+#callables get the test case
+URL_BUDGETS = [
+    ('invoices:index', {}, 4),
+    ('invoices:year', {'year': 2020}, 5),
+    ('invoices:year_rows', {'year': 2020}, 3),
+    ('invoices:year_chart', {'year': 2020}, 4),
+    ('invoices:year_download', {'year': 2020}, 3),
+    ('invoices:month', {'year': 2020, 'month': 5}, 5),
+    ('invoices:month_download', {'year': 2020, 'month': 5}, 3),
+    ('invoices:month_chart', {'year': 2020, 'month': 5}, 4),
+    ('invoices:export', {}, 3),
+    ('invoices:vat', {}, 3),
+    ('invoices:vat_json', {}, 3),
+    ('invoices:vat_csv', {}, 3),
+    ('invoices:aging', {}, 3),
+    ('invoices:aging_json', {}, 3),
+    ('invoices:search', {}, 6),
+    ('invoices:search_json', {}, 6),
+    ('invoices:add', {}, 2),
+    ('invoices:csv', {}, 2),
+    ('invoices:csv_job', {'job': lambda test: test.job}, 3),
+    ('invoices:cache_stats', {}, 2),
+    ('invoices:change', {'pk': lambda test: test.invoice_id}, 3),
+    ('invoices:delete', {'pk': lambda test: test.invoice_id}, 2),
+    ]
+#query strings of urls that need one
+URL_QUERIES = {
+    'invoices:search': '?q=client',
+    'invoices:search_json': '?q=client',
+    }
+#queries allowed to import files: fixed ones plus those of each chunk of
+#CHUNK_SIZE rows, never one per row. On sqlite bulk inserts take a query
+#for about 90 rows
+IMPORT_BUDGETS = {
+    'csv': (4, 20),
+    'xml': (11, 9),
+    'queue': (29, 14),
+    }
+
+def make_invoices(start, count):
+    """Invoices numbered from start, mostly in 2020, with rollups"""
+    first = date(2020, 1, 1)
+    Invoice.objects.bulk_create([Invoice(number=f'B{i}', client='Client',
+        active=i % 3 == 0, date=first + timedelta(days=i % 366),
+        amount=100, vat=22, category='A01PR' if i % 3 == 0 else 'P01AU',
+        paid=i % 2 == 0) for i in range(start, start + count)],
+        batch_size=500)
+    rebuild()
+
+def make_csv(rows):
+    return '\n'.join([f'C{i},Client,,{i % 28 + 1:02d}/05/20,Foo,1000,0,220,'
+        'P00,' for i in range(rows)])
+
+def make_xml(rows):
+    bodies = ''.join(['<FatturaElettronicaBody><Data>2020-05-02</Data>'
+        f'<Numero>X{i}</Numero><Descrizione>Foo</Descrizione>'
+        '<PrezzoTotale>1000</PrezzoTotale><Imposta>220</Imposta>'
+        '</FatturaElettronicaBody>' for i in range(rows)])
+    return ('<FatturaElettronica><FatturaElettronicaHeader>'
+        '<CedentePrestatore><Denominazione>Fornitore</Denominazione>'
+        '</CedentePrestatore><CessionarioCommittente><Denominazione>'
+        'Associazione Professionale Perilli</Denominazione>'
+        '</CessionarioCommittente></FatturaElettronicaHeader>' + bodies +
+        '</FatturaElettronica>')
+
+class QueryBudgetMixin:
+    """Counts queries of a block, see assertBudget"""
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def assertBudget(self, counts, budget, label):
+        """Counts map sizes to queries, none above the budget and all the
+        same, or queries grow with data"""
+        for size, count in counts.items():
+            self.assertLessEqual(count, budget,
+                f'{label}: {count} queries with {size} rows, budget {budget}')
+        self.assertEqual(len(set(counts.values())), 1,
+            f'{label}: queries grow with data {counts}')
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'))
+class URLQueryBudgetTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(username='budget',
+            password='P4s5W0r6', email='budget@example.com')
+        cls.job = uuid.uuid4()
+        CSVInvoice.objects.create(csv=SimpleUploadedFile('budget_job.csv',
+            b''), job=cls.job, status='P')
+
+    def tearDown(self):
+        path = os.path.join(settings.MEDIA_ROOT,
+            'uploads/invoices/csv/budget_job.csv')
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def get(self, url):
+        #cold caches, pages should not lean on them to keep within budget
+        cache.clear()
+        search._fts_tables.clear()
+        response = self.client.get(url)
+        self.assertIn(response.status_code, (200, 304), url)
+        if response.streaming:
+            for chunk in response.streaming_content:
+                pass
+
+    def test_urls_within_budget(self):
+        self.client.force_login(self.user)
+        counts = {name: {} for name, kwargs, budget in URL_BUDGETS}
+        made = 0
+        for size in SIZES:
+            make_invoices(made, size - made)
+            made = size
+            self.invoice_id = Invoice.objects.order_by('id').first().id
+            for name, kwargs, budget in URL_BUDGETS:
+                kwargs = {k: v(self) if callable(v) else v
+                    for k, v in kwargs.items()}
+                url = reverse(name, kwargs=kwargs) + URL_QUERIES.get(name,
+                    '')
+                counts[name][size] = self.count_queries(
+                    lambda: self.get(url))
+        for name, kwargs, budget in URL_BUDGETS:
+            with self.subTest(name):
+                self.assertBudget(counts[name], budget, name)
+
+    def test_every_url_has_a_budget(self):
+        names = set(f'invoices:{p.name}' for p in urlpatterns)
+        #metrics is a 404 unless a Prometheus backend is on
+        self.assertEqual(names - {'invoices:metrics'},
+            set(name for name, kwargs, budget in URL_BUDGETS))
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'))
+class ImportQueryBudgetTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        adder = User.objects.create_user(username='adder',
+            password='P4s5W0r6')
+        adder.groups.add(Group.objects.get(name='Accounting'))
+
+    def tearDown(self):
+        directory = os.path.join(settings.MEDIA_ROOT, 'uploads/invoices/csv')
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.startswith('budget_'):
+                    os.remove(os.path.join(directory, name))
+
+    def check_import(self, kind, run):
+        """Run(size) imports a file of size rows, each size on its own"""
+        base, per_chunk = IMPORT_BUDGETS[kind]
+        for size in SIZES:
+            sid = transaction.savepoint()
+            count = self.count_queries(lambda: run(size))
+            chunks = ceil(size / CHUNK_SIZE)
+            budget = base + per_chunk * chunks
+            self.assertEqual(Invoice.objects.count(), size)
+            self.assertLessEqual(count, budget, f'{kind}: {count} queries '
+                f'for {size} rows in {chunks} chunks, budget {budget}')
+            transaction.savepoint_rollback(sid)
+
+    def test_csv_upload_within_budget(self):
+        self.check_import('csv', lambda size: CSVInvoice.objects.create(
+            csv=SimpleUploadedFile(f'budget_{size}.csv',
+            make_csv(size).encode())))
+
+    def test_xml_upload_within_budget(self):
+        self.check_import('xml', lambda size: CSVInvoice.objects.create(
+            csv=SimpleUploadedFile(f'budget_{size}.xml',
+            make_xml(size).encode())))
+
+    def test_queued_files_within_budget(self):
+        def run(size):
+            half = size // 2
+            CSVInvoice.objects.create(csv=SimpleUploadedFile(
+                f'budget_{size}_a.csv', make_csv(half).encode()), status='P')
+            CSVInvoice.objects.create(csv=SimpleUploadedFile(
+                f'budget_{size}_b.xml', make_xml(size - half).encode()),
+                status='P')
+            call_command('process_invoice_files', '--once',
+                stdout=StringIO())
+        self.check_import('queue', run)
@@ -0,0 +1,397 @@
+import gzip
+import os
+import re
+import socketserver
+import tempfile
+import threading
+import time
+from email.message import EmailMessage
+from email.policy import SMTP
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.utils.translation import gettext as _
+
+from users.models import User
+from accounting.models import Invoice, CSVInvoice, MailCheckpoint
+from accounting.management.commands.fetch_invoice_emails import (
+    fetch_messages)
+from accounting.benchmarks.generator import make_invoices
+from accounting.benchmarks.suite import run_suite, compare
+
+class FakeAttachment:
+    def __init__(self, filename, payload):
+        self.filename = filename
+        self.payload = payload
+        self.content_type = 'text/csv'
+
+class FakeMessage:
+    def __init__(self, uid, from_, attachments):
+        self.uid = uid
+        self.from_ = from_
+        self.attachments = attachments
+
+class FakeIdle:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def wait(self, timeout):
+        self.mailbox.waits += 1
+        return []
+
+class FakeFolder:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def status(self, folder, options):
+        return {'UIDVALIDITY': self.mailbox.uid_validity}
+
+class FakeMailBox:
+    """Stands in for a logged in imap_tools MailBox"""
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetches = 0
+        self.waits = 0
+        self.logins = 0
+        self.criteria = []
+        self.uid_validity = 1
+        self.idle = FakeIdle(self)
+        self.folder = FakeFolder(self)
+
+    def __enter__(self):
+        self.logins += 1
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def fetch(self, criteria, mark_seen=True, **kwargs):
+        self.fetches += 1
+        self.criteria.append(str(criteria))
+        return self.messages
+
+class StubIMAPHandler(socketserver.StreamRequestHandler):
+    """Just enough IMAP4rev1 for imap_tools: one INBOX, UID SEARCH of
+    unseen messages with SUBJECT and UID n:*, UID FETCH of whole messages
+    and IDLE, which delivers messages waiting in server.arrivals"""
+
+    def send(self, *lines):
+        for line in lines:
+            self.wfile.write(line if isinstance(line, bytes) else
+                line.encode())
+            self.wfile.write(b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.send('* OK stub ready')
+        for line in self.rfile:
+            tag, command, *args = line.decode().rstrip('\r\n').split(' ', 2)
+            command = command.upper()
+            if command == 'UID':
+                command = 'UID ' + args[0].split(' ', 1)[0].upper()
+                args = args[0].split(' ', 1)[1:]
+            args = args[0] if args else ''
+            server.commands.append(command)
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1 IDLE')
+            elif command == 'LOGIN':
+                if args != f'"{server.user}" "{server.password}"':
+                    self.send(f'{tag} NO wrong credentials')
+                    continue
+            elif command == 'SELECT':
+                self.send(f'* {len(server.messages)} EXISTS',
+                    f'* OK [UIDVALIDITY {server.uid_validity}] UIDs valid')
+            elif command == 'STATUS':
+                self.send(f'* STATUS "INBOX" (UIDVALIDITY '
+                    f'{server.uid_validity})')
+            elif command == 'UID SEARCH':
+                subject = re.search(r'SUBJECT "([^"]*)"', args).group(1)
+                first = re.search(r'UID (\d+):\*', args)
+                uids = [uid for uid, (message, seen) in
+                    server.messages.items() if not seen and
+                    message['Subject'] == subject]
+                if first:
+                    #n:* always includes the last message, as servers do
+                    uids = [uid for uid in uids if uid >= int(first.group(1))
+                        or uid == max(server.messages)]
+                self.send('* SEARCH ' + ' '.join(str(uid) for uid in uids))
+            elif command == 'UID FETCH':
+                uid = int(args.split(' ', 1)[0])
+                message, seen = server.messages[uid]
+                server.messages[uid] = (message, True)
+                body = message.as_bytes(policy=SMTP)
+                self.send(f'* {uid} FETCH (UID {uid} FLAGS (\\Seen) '
+                    f'RFC822.SIZE {len(body)} BODY[] {{{len(body)}}}',
+                    body + b')')
+            elif command == 'IDLE':
+                self.send('+ idling')
+                if server.arrivals:
+                    #announced later, not read along with the continuation
+                    time.sleep(0.2)
+                    uid = max(server.messages, default=0) + 1
+                    server.messages[uid] = (server.arrivals.pop(0), False)
+                    self.send(f'* {len(server.messages)} EXISTS')
+                #untagged DONE ends IDLE
+                self.rfile.readline()
+            elif command == 'LOGOUT':
+                self.send('* BYE logging out', f'{tag} OK LOGOUT completed')
+                return
+            else:
+                self.send(f'{tag} BAD unknown command')
+                continue
+            self.send(f'{tag} OK {command} completed')
+
+class StubIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, user, password):
+        super().__init__(('127.0.0.1', 0), StubIMAPHandler)
+        self.user = user
+        self.password = password
+        self.uid_validity = 1
+        #uid: (message, seen)
+        self.messages = {}
+        self.arrivals = []
+        self.commands = []
+
+def make_email(sender, filename, payload):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = 'invoices@example.com'
+    message['Subject'] = _('invoices')
+    message.set_content('See attachment')
+    message.add_attachment(payload, maintype='text', subtype='csv',
+        filename=filename)
+    return message
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'),
+    IMAP_HOST='localhost', IMAP_USER='invoices', FETCH_EMAILS=True)
+class PollInvoiceEmailsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        adder = User.objects.create_user(username='adder',
+            password='P4s5W0r6', email='adder@example.com')
+        adder.groups.add(Group.objects.get(name='Accounting'))
+        User.objects.create_user(username='stranger', password='P4s5W0r6',
+            email='stranger@example.com')
+
+    def tearDown(self):
+        for name in ('mail_1', 'mail_2', 'mail_3'):
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+                f'uploads/invoices/csv/{name}.csv')):
+                os.remove(os.path.join(settings.MEDIA_ROOT,
+                    f'uploads/invoices/csv/{name}.csv'))
+
+    def test_poller_keeps_one_session(self):
+        row = b'M/1,Client,,01/02/20,Foo,1000,0,220,P00,'
+        mailbox = FakeMailBox([
+            FakeMessage('1', 'adder@example.com',
+                [FakeAttachment('mail_1.csv', row)]),
+            FakeMessage('2', 'stranger@example.com',
+                [FakeAttachment('mail_2.csv', row)]),
+            ])
+        with mock.patch('accounting.management.commands.'
+            'fetch_invoice_emails.get_mailbox', return_value=mailbox):
+            call_command('poll_invoice_emails', rounds=3, stdout=StringIO())
+        self.assertEqual(mailbox.logins, 1)
+        self.assertEqual(mailbox.fetches, 3)
+        self.assertEqual(mailbox.waits, 2)
+        self.assertEqual(CSVInvoice.objects.count(), 1)
+        self.assertEqual(Invoice.objects.get().number, 'M/1')
+
+    def test_poller_survives_database_errors(self):
+        mailbox = FakeMailBox([])
+        fetch = 'accounting.management.commands.fetch_invoice_emails.'
+        err = StringIO()
+        with mock.patch(fetch + 'get_mailbox', return_value=mailbox), \
+            mock.patch(fetch + 'fetch_messages',
+            side_effect=[OperationalError('gone'), None, None]):
+            call_command('poll_invoice_emails', rounds=2, interval=0,
+                stdout=StringIO(), stderr=err)
+        #logged in again after the error
+        self.assertEqual(mailbox.logins, 2)
+        self.assertIn('Database error: gone', err.getvalue())
+
+    @override_settings(FETCH_EMAILS=False)
+    def test_poller_honours_fetch_emails(self):
+        with mock.patch('accounting.management.commands.'
+            'fetch_invoice_emails.get_mailbox') as get_mailbox:
+            call_command('poll_invoice_emails', rounds=1, stdout=StringIO())
+        get_mailbox.assert_not_called()
+
+    def test_fetch_skips_seen_uids_and_known_attachments(self):
+        row = b'M/1,Client,,01/02/20,Foo,1000,0,220,P00,'
+        mailbox = FakeMailBox([FakeMessage('7', 'adder@example.com',
+            [FakeAttachment('mail_1.csv', row)])])
+        fetch_messages(mailbox)
+        self.assertEqual(MailCheckpoint.objects.get().last_uid, 7)
+        #marked unread again, the same file forwarded in a new message
+        mailbox.messages.append(FakeMessage('8', 'adder@example.com',
+            [FakeAttachment('mail_3.csv', row)]))
+        fetch_messages(mailbox)
+        self.assertIn('UID 8:*', mailbox.criteria[1])
+        self.assertEqual(CSVInvoice.objects.count(), 1)
+        self.assertEqual(MailCheckpoint.objects.get().last_uid, 8)
+        #UIDVALIDITY changed, the server renumbered its messages
+        mailbox.uid_validity = 2
+        mailbox.messages = []
+        fetch_messages(mailbox)
+        self.assertEqual(MailCheckpoint.objects.get().last_uid, 0)
+
+    @override_settings(ACCOUNTING_METRICS=[
+        'accounting.instrumentation.LoggingBackend'])
+    def test_fetch_timings_and_import_metrics(self):
+        row = b'M/1,Client,,01/02/20,Foo,1000,0,220,P00,'
+        mailbox = FakeMailBox([FakeMessage('7', 'adder@example.com',
+            [FakeAttachment('mail_1.csv', row)])])
+        with self.assertLogs('accounting.metrics') as logs:
+            fetch_messages(mailbox)
+        output = '\n'.join(logs.output)
+        self.assertIn('timing accounting.imap.seconds=', output)
+        self.assertIn('step=fetch', output)
+        self.assertIn('counter accounting.imap.attachments=1', output)
+        self.assertIn('counter accounting.import.rows=1 kind=csv', output)
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'),
+    FETCH_EMAILS=True, IMAP_SSL=False, IMAP_HOST='127.0.0.1',
+    IMAP_USER='invoices', IMAP_PWD='s3cr3t')
+class IMAPServerTest(TestCase):
+    """Fetching and polling against a local stand-in IMAP server"""
+
+    @classmethod
+    def setUpTestData(cls):
+        adder = User.objects.create_user(username='adder',
+            password='P4s5W0r6', email='adder@example.com')
+        adder.groups.add(Group.objects.get(name='Accounting'))
+
+    def setUp(self):
+        self.server = StubIMAPServer('invoices', 's3cr3t')
+        thread = threading.Thread(target=self.server.serve_forever,
+            daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        port = override_settings(IMAP_PORT=self.server.server_address[1])
+        port.enable()
+        self.addCleanup(port.disable)
+
+    def tearDown(self):
+        for name in ('imap_1', 'imap_2'):
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+                f'uploads/invoices/csv/{name}.csv')):
+                os.remove(os.path.join(settings.MEDIA_ROOT,
+                    f'uploads/invoices/csv/{name}.csv'))
+
+    def test_fetch_invoice_emails(self):
+        self.server.messages[1] = (make_email('adder@example.com',
+            'imap_1.csv', b'I/1,Client,,01/02/20,Foo,1000,0,220,P00,'),
+            False)
+        call_command('fetch_invoice_emails')
+        self.assertEqual(Invoice.objects.get().number, 'I/1')
+        self.assertTrue(self.server.messages[1][1])
+        self.assertEqual(MailCheckpoint.objects.get().last_uid, 1)
+        #nothing new, the last message comes back from UID 2:* and is skipped
+        self.server.messages[1] = (self.server.messages[1][0], False)
+        call_command('fetch_invoice_emails')
+        self.assertEqual(CSVInvoice.objects.count(), 1)
+        self.assertEqual(self.server.commands.count('LOGIN'), 2)
+
+    @override_settings(IMAP_PWD='wrong')
+    def test_poller_logs_in_again_after_imap_errors(self):
+        err = StringIO()
+        with mock.patch('time.sleep', side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('poll_invoice_emails', rounds=1, stderr=err)
+        self.assertEqual(self.server.commands.count('LOGIN'), 2)
+        self.assertIn('IMAP error', err.getvalue())
+
+    def test_poller_waits_with_idle(self):
+        self.server.messages[1] = (make_email('adder@example.com',
+            'imap_1.csv', b'I/1,Client,,01/02/20,Foo,1000,0,220,P00,'),
+            False)
+        #delivered by the server while the poller idles
+        self.server.arrivals.append(make_email('adder@example.com',
+            'imap_2.csv', b'I/2,Client,,01/02/20,Foo,1000,0,220,P00,'))
+        call_command('poll_invoice_emails', rounds=2, interval=10,
+            stdout=StringIO())
+        self.assertEqual(sorted(Invoice.objects.values_list('number',
+            flat=True)), ['I/1', 'I/2'])
+        self.assertEqual(self.server.commands.count('LOGIN'), 1)
+        self.assertEqual(self.server.commands.count('IDLE'), 1)
+        self.assertEqual(self.server.commands[-1], 'LOGOUT')
+        self.assertEqual(MailCheckpoint.objects.get().last_uid, 2)
+
+class ProcessInvoiceFilesTest(TestCase):
+
+    def test_worker_survives_database_errors(self):
+        out, err = StringIO(), StringIO()
+        with mock.patch('accounting.management.commands.process_invoice_files.'
+            'process_pending', side_effect=[OperationalError('gone'), 3,
+            KeyboardInterrupt]), mock.patch('time.sleep'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('process_invoice_files', stdout=out, stderr=err)
+        self.assertIn('Database error: gone', err.getvalue())
+        self.assertIn('Parsed 3 file(s)', out.getvalue())
+
+class ExportInvoicesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i, day in enumerate(['2019-03-01', '2020-03-01', '2020-04-01']):
+            Invoice.objects.create(number=f'00{i}', client = 'Mr. Client',
+                active = i != 1, date = day, amount = 100,
+                category = 'A01PR' if i != 1 else 'P01AU')
+
+    def test_one_file_per_year(self):
+        with tempfile.TemporaryDirectory() as directory:
+            out = StringIO()
+            call_command('export_invoices', directory, '--workers', '1',
+                stdout=out)
+            paths = out.getvalue().split()
+            self.assertEqual([os.path.basename(p) for p in paths],
+                ['Invoices-2019.csv.gz', 'Invoices-2020.csv.gz'])
+            with gzip.open(paths[1], 'rt') as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+
+    def test_filters(self):
+        with tempfile.TemporaryDirectory() as directory:
+            out = StringIO()
+            call_command('export_invoices', directory, '--workers', '1',
+                '--active', 'yes', '--start', '2020', '--compression',
+                'none', stdout=out)
+            paths = out.getvalue().split()
+            self.assertEqual(len(paths), 1)
+            with open(paths[0]) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[1].startswith('002,'))
+
+class BenchmarkSuiteTest(TestCase):
+
+    def test_generator_is_deterministic(self):
+        self.assertEqual(list(make_invoices(20, seed=3)),
+            list(make_invoices(20, seed=3)))
+        self.assertNotEqual(list(make_invoices(20, seed=3)),
+            list(make_invoices(20, seed=4)))
+
+    def test_suite_runs_and_compares(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(MEDIA_ROOT=directory):
+                data = run_suite(directory, 30, ['parse_csv', 'parse_xml',
+                    'year_view', 'year_download'], per_file=10)
+        self.assertEqual(set(data['results']), {'parse_csv', 'parse_xml',
+            'year_view', 'year_download'})
+        self.assertEqual(Invoice.objects.count(), 30)
+        self.assertTrue(all(r['queries'] for r in data['results'].values()))
+        lines, regressed = compare(data, data)
+        self.assertEqual(len(lines), 4)
+        self.assertFalse(regressed)
+        worse = {'results': {'year_view': dict(data['results']['year_view'],
+            queries=data['results']['year_view']['queries'] + 1)}}
+        self.assertTrue(compare(data, worse)[1])
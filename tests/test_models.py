@@ -1,10 +1,25 @@
 import os
+import socket
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
 from django.conf import settings
+from django.core.management import call_command
+from django.db import (connection, IntegrityError, DatabaseError,
+    OperationalError, )
 from django.test import TestCase, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.utils import CaptureQueriesContext
 
-from accounting.models import Invoice, CSVInvoice
+from accounting.models import Invoice, CSVInvoice, CategoryRule, InvoiceRollup
+from accounting.classifier import (get_classifier, invalidate_rules, Matcher,
+    MATCHER_MIN_RULES, )
+from accounting.benchmarks.classifier import make_rules, make_text, scan
+from accounting.importers import parse_amount, parse_amounts, parse_files
+from accounting.pagination import after
+from accounting.rollups import aggregate, get_period_filter, refresh_periods
+from accounting.instrumentation import get_backends, PrometheusBackend, timer
 
 class InvoiceModelTest(TestCase):
     """Testing all methods that don't need SimpleUploadedFile"""
@@ -186,13 +201,68 @@ class XMLInvoiceModelTest(TestCase):
 
     def tearDown(self):
         """Checks if created file exists, then removes it"""
-        list = ('bad_file', 'created_file', 'modified_file')
+        list = ('bad_file', 'created_file', 'modified_file', 'batch_0',
+            'batch_1', 'batch_2')
         for name in list:
             if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
                 f'uploads/invoices/csv/{name}.xml')):
                 os.remove(os.path.join(settings.MEDIA_ROOT,
                     f'uploads/invoices/csv/{name}.xml'))
 
+    @override_settings(ACCOUNTING_XML_WORKERS=1)
+    def test_xmlinvoices_batch_error_leaves_files_done(self):
+        content = """
+<Fattura versione="FPR12">
+    <CedentePrestatore><Denominazione>Fornitore</Denominazione>
+    </CedentePrestatore>
+    <Data>1966-04-13</Data>
+    <Numero>B%d/1966</Numero>
+    <PrezzoTotale>1000</PrezzoTotale>
+    <Imposta>100</Imposta>
+</Fattura>"""
+        instances = [CSVInvoice.objects.create(status='P',
+            csv=SimpleUploadedFile(f'batch_{i}.xml', (content % i).encode(),
+            'text/xml')) for i in range(3)]
+        #the first file is written, the second batch breaks
+        with mock.patch('accounting.importers.CHUNK_SIZE', 1), mock.patch(
+            'accounting.importers.refresh_periods',
+            side_effect=[None, DatabaseError]):
+            with self.assertRaises(DatabaseError), self.assertLogs(
+                'accounting.importers', 'ERROR'):
+                parse_files(instances)
+        counters = [(i.status, i.created, i.failed) for i in
+            CSVInvoice.objects.filter(id__in=[i.id for i in instances]
+            ).order_by('id')]
+        self.assertEquals(counters, [('D', 1, 0), ('D', 0, 1), ('D', 0, 1)])
+        self.assertTrue(Invoice.objects.filter(number='B0/1966').exists())
+        self.assertFalse(Invoice.objects.filter(number='B1/1966').exists())
+
+    def test_xmlinvoices_database_outage_is_raised(self):
+        content = """
+<Fattura versione="FPR12">
+    <CedentePrestatore><Denominazione>Fornitore</Denominazione>
+    </CedentePrestatore>
+    <Data>1966-05-13</Data>
+    <Numero>C%d/1966</Numero>
+    <PrezzoTotale>1000</PrezzoTotale>
+    <Imposta>100</Imposta>
+</Fattura>"""
+        instances = [CSVInvoice.objects.create(status='P',
+            csv=SimpleUploadedFile(f'outage_{i}.xml', (content % i).encode(),
+            'text/xml')) for i in range(2)]
+        #not taken for a row breaking the batch
+        with mock.patch('accounting.models.Invoice.objects.bulk_create',
+            side_effect=OperationalError('gone')):
+            with self.assertRaises(OperationalError), self.assertLogs(
+                'accounting.importers', 'ERROR'):
+                parse_files(instances)
+        counters = [(i.status, i.created, i.failed) for i in
+            CSVInvoice.objects.filter(id__in=[i.id for i in instances]
+            ).order_by('id')]
+        self.assertEquals(counters, [('D', 0, 1), ('D', 0, 1)])
+        self.assertFalse(Invoice.objects.filter(number__startswith='C'
+            ).exists())
+
     def test_xmlinvoice_fails_loading_bad_file(self):
         xmlinv = CSVInvoice.objects.get(date='2020-05-05 15:53:00+02')
         self.assertEquals(xmlinv.created, 0)
@@ -211,3 +281,388 @@ class XMLInvoiceModelTest(TestCase):
         self.assertEquals(xmlinv.created, 0)
         self.assertEquals(xmlinv.modified, 1)
         self.assertEquals(xmlinv.failed, 0)
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'))
+class CSVInvoiceBulkTest(TestCase):
+    """Testing batched import of CSV files"""
+    @classmethod
+    def setUpTestData(cls):
+        Invoice.objects.create(number='001', client = 'Old Client',
+            active = True, date = '2020-01-10', descr = 'Old',
+            amount = 1, security = 0, vat = 0, category = 'A00',
+            paid = False)
+
+    def tearDown(self):
+        """Checks if created file exists, then removes it"""
+        list = ('bulk_file', 'rows_10', 'rows_50', 'chunks')
+        for name in list:
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+                f'uploads/invoices/csv/{name}.csv')):
+                os.remove(os.path.join(settings.MEDIA_ROOT,
+                    f'uploads/invoices/csv/{name}.csv'))
+
+    def upload(self, name, content):
+        return CSVInvoice.objects.create(csv = SimpleUploadedFile(name,
+            content.encode(), content_type="text/csv"))
+
+    def test_csvinvoice_bulk_counters_and_values(self):
+        content = """Numero,Cliente,Attiva?,gg/mm/aa,Descrizione,Imponibile,Contributi,Iva,Categoria,Pagata?
+001,New Client,yes,10/01/20,Foo,"1.000,00",10,100,A01PR,yes
+002,Client,yes,11/01/20,Foo,1000,10,100,A00,
+002,Client,yes,11/01/20,Bar,2000,20,200,A00,
+003,Client,yes,not a date,Foo,1000,10,100,A00,"""
+        csvinv = self.upload('bulk_file.csv', content)
+        self.assertEquals(csvinv.created, 1)
+        self.assertEquals(csvinv.modified, 2)
+        self.assertEquals(csvinv.failed, 1)
+        inv = Invoice.objects.get(number='001')
+        self.assertEquals(inv.client, 'New Client')
+        self.assertEquals(inv.get_total(), 1110)
+        self.assertTrue(inv.paid)
+        inv = Invoice.objects.get(number='002')
+        self.assertEquals(inv.descr, 'Bar')
+        self.assertEquals(inv.get_total(), 2220)
+        #bulk writes refresh rollups too
+        self.assertEquals(InvoiceRollup.objects.get(year=2020, month=1,
+            category='A01PR').total, 1110)
+        self.assertEquals(InvoiceRollup.objects.get(year=2020, month=1,
+            category='A00').total, 2220)
+
+    @override_settings(ACCOUNTING_NATIVE_UPSERT=False)
+    def test_csvinvoice_bulk_without_native_upsert(self):
+        self.test_csvinvoice_bulk_counters_and_values()
+
+    @skipUnless(connection.features.supports_update_conflicts_with_target,
+        'No INSERT ... ON CONFLICT')
+    def test_csvinvoice_bulk_native_upsert(self):
+        content = '\n'.join(['001,New Client,yes,10/01/20,Foo,10,0,0,A00,',
+            '004,Client,yes,12/01/20,Foo,10,0,0,A00,'])
+        with CaptureQueriesContext(connection) as ctx:
+            csvinv = self.upload('bulk_file.csv', content)
+        self.assertEquals((csvinv.created, csvinv.modified), (1, 1))
+        writes = [q['sql'] for q in ctx.captured_queries
+            if 'accounting_invoice"' in q['sql'] and
+            not q['sql'].startswith('SELECT')]
+        self.assertEquals(len(writes), 1)
+        self.assertIn('ON CONFLICT', writes[0])
+        self.assertEquals(Invoice.objects.get(number='001').client,
+            'New Client')
+
+    def test_csvinvoice_bulk_query_count_is_constant(self):
+        counts = []
+        for size in (10, 50):
+            content = '\n'.join([f'{size}-{i},Client,,01/02/20,Foo,1000,0,220,P00,'
+                for i in range(size)])
+            with CaptureQueriesContext(connection) as ctx:
+                csvinv = self.upload(f'rows_{size}.csv', content)
+            self.assertEquals(csvinv.created, size)
+            counts.append(len(ctx.captured_queries))
+        self.assertEquals(counts[0], counts[1])
+
+    def test_csvinvoice_progress_saved_every_chunk(self):
+        content = '\n'.join([f'P-{i},Client,,01/03/20,Foo,1000,0,220,P00,'
+            for i in range(5)])
+        with mock.patch('accounting.importers.CHUNK_SIZE', 2):
+            with CaptureQueriesContext(connection) as ctx:
+                csvinv = self.upload('chunks.csv', content)
+        updates = [q for q in ctx.captured_queries
+            if q['sql'].startswith('UPDATE "accounting_csvinvoice"')]
+        #three chunks plus the final count
+        self.assertEquals(len(updates), 4)
+        csvinv.refresh_from_db()
+        self.assertEquals(csvinv.created, 5)
+
+    def test_csvinvoice_crash_keeps_committed_counts(self):
+        content = '\n'.join([f'K-{i},Client,,01/03/20,Foo,1000,0,220,P00,'
+            for i in range(5)] + ['K-x,Client,,bad,Foo,1000,0,220,P00,'])
+        with mock.patch('accounting.importers.CHUNK_SIZE', 2), mock.patch(
+            'accounting.importers.refresh_periods',
+            side_effect=[None, DatabaseError]):
+            with self.assertRaises(DatabaseError):
+                self.upload('chunks.csv', content)
+        csvinv = CSVInvoice.objects.latest('id')
+        #first chunk written, the second one and the rest fail as a whole
+        self.assertEquals((csvinv.created, csvinv.modified, csvinv.failed),
+            (2, 0, 1))
+        self.assertEquals(Invoice.objects.filter(number__startswith='K-'
+            ).count(), 2)
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'))
+class FatturaPAModelTest(TestCase):
+    """Testing FatturaPA files with namespaces and many bodies"""
+
+    def tearDown(self):
+        if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+            'uploads/invoices/csv/lotto.xml')):
+            os.remove(os.path.join(settings.MEDIA_ROOT,
+                'uploads/invoices/csv/lotto.xml'))
+
+    def test_xmlinvoice_many_bodies(self):
+        lines = ''.join(['<DettaglioLinee><Descrizione>Riga %d</Descrizione>'
+            '<PrezzoTotale>10.00</PrezzoTotale></DettaglioLinee>' % i
+            for i in range(1000)])
+        body = """<FatturaElettronicaBody>
+    <DatiGenerali><DatiGeneraliDocumento><Data>2021-03-0%d</Data>
+    <Numero>L/%d</Numero></DatiGeneraliDocumento>
+    <DatiOrdineAcquisto><Data>2020-01-01</Data><Numero>X</Numero>
+    </DatiOrdineAcquisto></DatiGenerali>
+    <DatiBeniServizi>%s
+    <DatiRiepilogo><Imposta>1100.00</Imposta></DatiRiepilogo>
+    <DatiRiepilogo><Imposta>100.00</Imposta></DatiRiepilogo>
+    </DatiBeniServizi></FatturaElettronicaBody>"""
+        content = """<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12"
+    xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+  <FatturaElettronicaHeader>
+    <CedentePrestatore><DatiAnagrafici><Anagrafica>
+      <Denominazione>Aruba S.p.A.</Denominazione>
+    </Anagrafica></DatiAnagrafici></CedentePrestatore>
+    <CessionarioCommittente><DatiAnagrafici><Anagrafica>
+      <Denominazione>Associazione Professionale Perilli</Denominazione>
+    </Anagrafica></DatiAnagrafici></CessionarioCommittente>
+  </FatturaElettronicaHeader>
+  %s%s<FatturaElettronicaBody><Broken/></FatturaElettronicaBody>
+</p:FatturaElettronica>""" % (body % (1, 1, lines), body % (2, 2, lines))
+        xmlinv = CSVInvoice.objects.create(csv = SimpleUploadedFile(
+            'lotto.xml', content.encode(), 'text/xml'))
+        self.assertEquals(xmlinv.created, 2)
+        self.assertEquals(xmlinv.failed, 1)
+        inv = Invoice.objects.get(number='L/2')
+        self.assertEquals(str(inv.date), '2021-03-02')
+        self.assertEquals(inv.client, 'Aruba S.p.A.')
+        self.assertEquals(inv.category, 'P14SE')
+        self.assertEquals(inv.amount, 10000)
+        self.assertEquals(inv.vat, 1200)
+        self.assertTrue(inv.descr.startswith('Riga 0\nRiga 1\n'))
+
+class CategoryRuleTest(TestCase):
+    """Testing the classifier built on category rules"""
+
+    def tearDown(self):
+        #rules created by tests are rolled back without signals
+        invalidate_rules()
+
+    def test_classifier_picks_lowest_priority(self):
+        classifier = get_classifier()
+        #'auto' (P01AU) beats 'telecom' (P04TE) wherever it is found
+        self.assertEquals(classifier.passive.guess('Telecom Autoparco'),
+            'P01AU')
+        self.assertEquals(classifier.active.guess('Collaudo e progetto'),
+            'A01PR')
+
+    def test_classifier_follows_rule_changes(self):
+        csvinv = CSVInvoice()
+        self.assertEquals(csvinv.guess_passive_category('Citroen'), 'P00')
+        rule = CategoryRule.objects.create(keyword='Citroen',
+            category='P01AU', priority=5)
+        self.assertEquals(csvinv.guess_passive_category('CITROEN spa'),
+            'P01AU')
+        rule.delete()
+        self.assertEquals(csvinv.guess_passive_category('Citroen'), 'P00')
+
+    def test_trie_matcher_agrees_with_scan(self):
+        #overlapping keywords, prefixes of others and repeated ones
+        rules = [('progetto', 'A01'), ('getto', 'A02'), ('pro', 'A03'),
+            ('progettazione', 'A04'), ('tto e', 'A05'), ('getto', 'A06'),
+            ('zione', 'A07')]
+        matcher = Matcher(rules, 'A00', min_rules=0)
+        for text in ('Progettazione', 'progetto', 'sgetto e pro', 'Azione',
+            'nulla', 'proget', '', 'progettazione e progetto'):
+            self.assertEquals(matcher.guess(text), scan(rules, text, 'A00'),
+                text)
+        rules = make_rules(300)
+        matcher = Matcher(rules, 'A00', min_rules=0)
+        for i, (keyword, category) in enumerate(rules[::7]):
+            text = make_text(500, seed=i) + keyword.upper() + make_text(50)
+            self.assertEquals(matcher.guess(text), scan(rules, text, 'A00'),
+                keyword)
+
+    def test_matcher_compiles_many_rules(self):
+        """Above MATCHER_MIN_RULES the trie regex is used, with the result
+        of scanning (timings are in benchmarks/classifier.py)"""
+        rules = make_rules(MATCHER_MIN_RULES * 2)
+        matcher = Matcher(rules, 'A00')
+        self.assertIsNone(matcher.keywords)
+        self.assertIsNotNone(matcher.regex)
+        texts = [make_text(2000)]
+        for i in range(0, len(rules), 11):
+            #a later keyword before an earlier one
+            later, earlier = rules[-1 - i][0], rules[i][0]
+            texts.append(make_text(300, seed=i) + later + make_text(100,
+                seed=i + 1) + earlier.upper())
+        for text in texts:
+            self.assertEquals(matcher.guess(text), scan(rules, text, 'A00'))
+
+@override_settings(MEDIA_ROOT=os.path.join(settings.MEDIA_ROOT, 'temp'))
+class CSVInvoiceDuplicateTest(TestCase):
+    """Testing that known files are neither stored nor parsed"""
+
+    def tearDown(self):
+        for name in ('first', 'second'):
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+                f'uploads/invoices/csv/{name}.csv')):
+                os.remove(os.path.join(settings.MEDIA_ROOT,
+                    f'uploads/invoices/csv/{name}.csv'))
+
+    def test_csvinvoice_duplicate_upload(self):
+        content = b'D/1,Client,,01/02/20,Foo,1000,0,220,P00,'
+        first = CSVInvoice.objects.create(csv = SimpleUploadedFile(
+            'first.csv', content, content_type="text/csv"))
+        self.assertEquals(first.created, 1)
+        with CaptureQueriesContext(connection) as ctx:
+            second = CSVInvoice.objects.create(csv = SimpleUploadedFile(
+                'second.csv', content, content_type="text/csv"))
+        #lookup of the digest and insert of the pointer
+        self.assertEquals(len(ctx.captured_queries), 2)
+        self.assertEquals(second.duplicate_of, first)
+        self.assertEquals(second.csv.name, first.csv.name)
+        self.assertEquals(second.created, 0)
+        self.assertFalse(os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+            'uploads/invoices/csv/second.csv')))
+
+class AmountParsingTest(TestCase):
+    """Testing the Decimal amount parser against prepare_float"""
+
+    def test_parse_amount_matches_prepare_float(self):
+        csvinv = CSVInvoice()
+        for value in ('€1.000,00', '€ 1.234,56', '1234,5', '1,234.56', '1.234',
+            '-12,30', '', '0'):
+            self.assertEquals(parse_amount(value),
+                Decimal(str(csvinv.prepare_float(value))))
+
+    def test_parse_amounts_column(self):
+        self.assertEquals(parse_amounts(['1,10', 'abc', '1,10',
+            '1.000.000,00', '']), [Decimal('1.10'), None, Decimal('1.10'),
+            None, Decimal('0')])
+
+class InvoiceRollupTest(TestCase):
+    """Testing that monthly rollups follow invoice changes"""
+
+    def get_rollup(self, year, month, category):
+        return InvoiceRollup.objects.get(year=year, month=month,
+            category=category)
+
+    def test_rollup_follows_save_move_and_delete(self):
+        inv = Invoice.objects.create(number='R1', client = 'Client',
+            active = True, date = '2020-05-09', amount = 1000, security = 10,
+            vat = 100, category = 'A00', paid = True)
+        Invoice.objects.create(number='R2', client = 'Client',
+            active = True, date = '2020-05-10', amount = 100, category = 'A00')
+        rollup = self.get_rollup(2020, 5, 'A00')
+        self.assertEquals(rollup.total, 1210)
+        self.assertEquals(rollup.count, 2)
+        self.assertEquals(rollup.paid_total, 1110)
+        self.assertEquals(rollup.get_unpaid_count(), 1)
+        inv = Invoice.objects.get(number='R1')
+        inv.date = '2020-06-01'
+        inv.save()
+        self.assertEquals(self.get_rollup(2020, 5, 'A00').total, 100)
+        self.assertEquals(self.get_rollup(2020, 6, 'A00').total, 1110)
+        inv.delete()
+        self.assertFalse(InvoiceRollup.objects.filter(month=6).exists())
+
+    def test_rebuild_matches_incremental(self):
+        for i in range(1, 13):
+            Invoice.objects.create(number=f'B{i}', client = 'Client',
+                active = bool(i % 2), date = f'2019-{i:02d}-01', amount = i,
+                category = 'X', paid = i > 6)
+        before = list(InvoiceRollup.objects.values_list('year', 'month',
+            'active', 'total', 'count', 'paid_count'))
+        call_command('rebuild_invoice_rollups', stdout=StringIO())
+        after = list(InvoiceRollup.objects.values_list('year', 'month',
+            'active', 'total', 'count', 'paid_count'))
+        self.assertEquals(before, after)
+        self.assertEquals(len(after), 12)
+
+    def test_refresh_upserts_rows_written_meanwhile(self):
+        inv = Invoice.objects.create(number='R1', client = 'Client',
+            active = True, date = '2020-05-09', amount = 1000,
+            category = 'A00')
+        rollup_id = self.get_rollup(2020, 5, 'A00').id
+        #as if another transaction refreshed the month in between
+        InvoiceRollup.objects.filter(month=5).update(total=1, count=9)
+        InvoiceRollup.objects.create(year=2020, month=5, active=False,
+            category='P00', amount=1, security=0, vat=0, total=1, count=1,
+            paid_total=0, paid_count=0)
+        refresh_periods([(2020, 5)])
+        self.assertEquals(list(InvoiceRollup.objects.values_list('category',
+            'total', 'count')), [('A00', 1000, 1)])
+        #updated in place rather than deleted and inserted again
+        self.assertEquals(InvoiceRollup.objects.get().id, rollup_id)
+        inv.delete()
+        self.assertFalse(InvoiceRollup.objects.exists())
+
+class InvoiceIndexTest(TestCase):
+    """Testing constraints and indexes of invoices"""
+    @classmethod
+    def setUpTestData(cls):
+        Invoice.objects.create(number='001', client = 'Client',
+            active = True, date = '2020-01-10', amount = 1, category = 'A00')
+
+    def test_number_and_date_are_unique(self):
+        with self.assertRaises(IntegrityError):
+            Invoice.objects.create(number='001', client = 'Client',
+                active = True, date = '2020-01-10', amount = 1)
+
+    @skipUnless(connection.vendor == 'sqlite', 'Query plans differ')
+    def test_archive_queries_use_indexes(self):
+        year = Invoice.objects.filter(date__gte='2020-01-01',
+            date__lt='2021-01-01').order_by('-date', '-id')
+        self.assertIn('invoice_date_id_idx', year.explain())
+        page = Invoice.objects.filter(after('2020-01-10', 1)).order_by(
+            '-date', '-id')[:51]
+        self.assertIn('invoice_date_id_idx', page.explain())
+        lookup = Invoice.objects.filter(number__in=['001'],
+            date__range=('2020-01-01', '2020-01-31'))
+        #sqlite names the index of the unique constraint itself
+        self.assertIn('USING INDEX', lookup.explain())
+        self.assertIn('number=?', lookup.explain())
+        totals = aggregate(Invoice.objects.filter(get_period_filter(
+            [(2020, 1)])))
+        self.assertIn('invoice_date_', totals.explain())
+        #as reports.aging() filters
+        unpaid = Invoice.objects.filter(paid=False,
+            date__lte='2020-06-30').order_by()
+        self.assertIn('invoice_unpaid_date_active_idx', unpaid.explain())
+
+class InstrumentationTest(TestCase):
+    """Testing metric backends and import metrics"""
+
+    def tearDown(self):
+        PrometheusBackend.values.clear()
+        if os.path.isfile(os.path.join(settings.MEDIA_ROOT,
+            'uploads/invoices/csv/metrics.csv')):
+            os.remove(os.path.join(settings.MEDIA_ROOT,
+                'uploads/invoices/csv/metrics.csv'))
+
+    def test_off_by_default(self):
+        self.assertEqual(get_backends(), [])
+
+    @override_settings(ACCOUNTING_METRICS=[
+        'accounting.instrumentation.PrometheusBackend'])
+    def test_import_metrics(self):
+        content = '\n'.join([f'{i},Client,,01/02/20,Foo,1000,0,220,P00,'
+            for i in range(3)] + ['9,Client,,not a date,Foo,1,0,0,P00,'])
+        CSVInvoice.objects.create(csv = SimpleUploadedFile('metrics.csv',
+            content.encode(), content_type="text/csv"))
+        text = PrometheusBackend.render()
+        self.assertIn('accounting_import_rows{kind="csv"} 4', text)
+        self.assertIn('accounting_import_bytes{kind="csv"} %d' %
+            len(content), text)
+        self.assertIn('accounting_import_db_seconds_count{kind="csv"} 1',
+            text)
+        self.assertIn('accounting_import_rows_per_second{kind="csv"}', text)
+
+    def test_statsd_datagrams(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        with override_settings(ACCOUNTING_METRICS=[
+            'accounting.instrumentation.StatsDBackend'],
+            ACCOUNTING_STATSD_HOST='127.0.0.1',
+            ACCOUNTING_STATSD_PORT=server.getsockname()[1]):
+            with timer('accounting.test', step='one'):
+                pass
+        data = server.recv(1024).decode()
+        server.close()
+        self.assertRegex(data, r'^accounting.test:[0-9.]+\|ms\|#step:one$')
@@ -3,7 +3,10 @@ from django.utils.translation import gettext_lazy as _
 
 from accounting.views import (InvoiceArchiveIndexView, InvoiceYearArchiveView,
     InvoiceMonthArchiveView, InvoiceCreateView, InvoiceUpdateView,
-    InvoiceDeleteView, CSVInvoiceCreateView, year_download, month_download,)
+    InvoiceDeleteView, CSVInvoiceCreateView, year_download, month_download,
+    csv_job_status, period_cache_stats, export_invoices, year_rows,
+    chart_data, metrics, VATReportView, vat_report_json, vat_report_csv,
+    AgingReportView, aging_report_json, InvoiceSearchView, search_json, )
     #CSVInvoiceMailTemplateView)
 
 app_name = 'invoices'
@@ -11,13 +14,28 @@ urlpatterns = [
     path('', InvoiceArchiveIndexView.as_view(), name = 'index'),
     path('<int:year>/', InvoiceYearArchiveView.as_view(),
         name = 'year'),
+    path(_('<int:year>/rows/'), year_rows, name = 'year_rows'),
+    path(_('<int:year>/chart/'), chart_data, name = 'year_chart'),
     path(_('<int:year>/download/'), year_download, name = 'year_download'),
     path('<int:year>/<int:month>/', InvoiceMonthArchiveView.as_view(),
         name = 'month'),
     path(_('<int:year>/<int:month>/download/'), month_download,
         name = 'month_download'),
+    path(_('<int:year>/<int:month>/chart/'), chart_data,
+        name = 'month_chart'),
+    path(_('export/'), export_invoices, name = 'export'),
+    path(_('vat/'), VATReportView.as_view(), name = 'vat'),
+    path(_('vat/json/'), vat_report_json, name = 'vat_json'),
+    path(_('vat/csv/'), vat_report_csv, name = 'vat_csv'),
+    path(_('aging/'), AgingReportView.as_view(), name = 'aging'),
+    path(_('aging/json/'), aging_report_json, name = 'aging_json'),
+    path(_('search/'), InvoiceSearchView.as_view(), name = 'search'),
+    path(_('search/json/'), search_json, name = 'search_json'),
     path(_('add/'), InvoiceCreateView.as_view(), name = 'add'),
     path(_('add/csv/'), CSVInvoiceCreateView.as_view(), name = 'csv'),
+    path(_('add/csv/<uuid:job>/'), csv_job_status, name = 'csv_job'),
+    path(_('cache/'), period_cache_stats, name = 'cache_stats'),
+    path('metrics/', metrics, name = 'metrics'),
     path(_('change/<pk>/'), InvoiceUpdateView.as_view(),
         name = 'change'),
     path(_('delete/<pk>/'), InvoiceDeleteView.as_view(),
@@ -1,27 +1,47 @@
 from decimal import Decimal
 import csv
-from datetime import datetime
+import hashlib
+import json
+import uuid
+from datetime import date
 
 from imap_tools import MailBox, AND
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.http import (HttpResponse, StreamingHttpResponse, JsonResponse,
+    Http404, )
 from django.shortcuts import render, get_object_or_404
-from django.views.generic import CreateView, UpdateView, FormView, TemplateView
+from django.template.loader import render_to_string
+from django.core.paginator import Paginator
+from django.views.generic import (CreateView, UpdateView, FormView, TemplateView,
+    ListView)
 from django.views.generic.dates import ( ArchiveIndexView, YearArchiveView,
-    MonthArchiveView, )
+    MonthArchiveView, MonthMixin, )
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.contrib.auth.decorators import permission_required
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils.translation import gettext as _
 from django.urls import reverse
-
-from .models import Invoice, CSVInvoice
-from .forms import InvoiceCreateForm, InvoiceDeleteForm, CSVInvoiceCreateForm
-from .management.commands.fetch_invoice_emails import do_command
+from django.views.decorators.http import condition
+
+from .caching import get_or_compute, get_stats
+from .instrumentation import (InstrumentedViewMixin, PrometheusBackend,
+    get_backends, instrument_view, )
+from .models import Invoice, CSVInvoice, InvoiceRollup, PeriodStamp
+from .exports import (csv_rows, filter_invoices, compress, get_extension,
+    get_content_type, )
+from .importers import parse_files
+from .pagination import KeysetPaginator
+from .forms import (InvoiceCreateForm, InvoiceDeleteForm, CSVInvoiceCreateForm,
+    InvoiceExportForm, VATReportForm, AgingReportForm, InvoiceSearchForm, )
+from .reports import vat_liquidation, aging
+from .search import search_invoices
 from .choices import CAT
 
-class InvoiceArchiveIndexView(PermissionRequiredMixin, ArchiveIndexView):
+class InvoiceArchiveIndexView(InstrumentedViewMixin, PermissionRequiredMixin,
+    ArchiveIndexView):
     model = Invoice
     permission_required = 'accounting.view_invoice'
     date_field = 'date'
@@ -30,9 +50,15 @@ class InvoiceArchiveIndexView(PermissionRequiredMixin, ArchiveIndexView):
     paginate_by = 50
     allow_empty = True
 
-    def setup(self, request, *args, **kwargs):
-        super(InvoiceArchiveIndexView, self).setup(request, *args, **kwargs)
-        do_command()
+    def paginate_queryset(self, queryset, page_size):
+        """Seeks pages with ?cursor= unless ACCOUNTING_KEYSET_PAGINATION is
+        False, ACCOUNTING_KEYSET_COUNT adds rows skipped to the context"""
+        if not getattr(settings, 'ACCOUNTING_KEYSET_PAGINATION', True):
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size,
+            getattr(settings, 'ACCOUNTING_KEYSET_COUNT', False))
+        page = paginator.page(self.request.GET.get('cursor'))
+        return (paginator, page, page.object_list, page.has_other_pages())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -46,65 +72,125 @@ class InvoiceArchiveIndexView(PermissionRequiredMixin, ArchiveIndexView):
             context['csv_created'] = self.request.GET['csv_created']
             context['csv_modified'] = self.request.GET['csv_modified']
             context['csv_failed'] = self.request.GET['csv_failed']
+        elif 'csv_job' in self.request.GET:
+            context['csv_job'] = self.request.GET['csv_job']
         return context
 
+def get_chart_data(totals):
+    """Chart context from (active, category, total) rows, one per group"""
+    context = {}
+    by_cat = {}
+    choices = CAT
+    #total active and passive invoices
+    active_sum = Decimal('0.00')
+    passive_sum = Decimal('0.00')
+    for active, category, total in totals:
+        by_cat[(active, category)] = by_cat.get((active, category),
+            Decimal('0.00')) + total
+        if active:
+            active_sum += total
+        else:
+            passive_sum += total
+    context['active_sum'] = round(active_sum, 0)
+    context['passive_sum'] = round(passive_sum, 0)
+    #total active invoices by category
+    active_cat = {}
+    active_left = Decimal('0.00')
+    for ch in choices:
+        if ch[0].startswith('A'):
+            sum = by_cat.get((True, ch[0]), Decimal('0.00'))
+            active_cat[ch[1].replace('A-', '')] = round(sum, 0)
+            active_left += sum
+        left = context['active_sum'] - active_left
+        active_cat[_('Other')] = round(left, 0)
+    context['active_cat'] = active_cat
+    #total passive invoices by category
+    passive_cat = {}
+    passive_left = Decimal('0.00')
+    for ch in choices:
+        if ch[0].startswith('P'):
+            sum = by_cat.get((False, ch[0]), Decimal('0.00'))
+            passive_cat[ch[1].replace('P-', '')] = round(sum, 0)
+            passive_left += sum
+        left = context['passive_sum'] - passive_left
+        passive_cat[_('Other')] = round(left, 0)
+    context['passive_cat'] = passive_cat
+    return context
+
+def get_period_rollups(year, month=None):
+    rollups = InvoiceRollup.objects.filter(year=year)
+    if month:
+        rollups = rollups.filter(month=month)
+    return rollups
+
+def get_period_chart_data(year, month=None):
+    #a few rollup rows instead of the period invoices
+    return get_chart_data(get_period_rollups(year, month).values_list(
+        'active', 'category', 'total'))
+
 class ChartMixin:
+    def get_rollups(self):
+        if isinstance(self, MonthMixin):
+            return get_period_rollups(self.get_year(), self.get_month())
+        return get_period_rollups(self.get_year())
+
+    def get_chart_data(self):
+        totals = self.get_rollups().values_list('active', 'category', 'total')
+        return get_chart_data(totals)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        active = context['all_invoices'].filter(active = True)
-        passive = context['all_invoices'].filter(active = False)
-        choices = CAT
-        #total active invoices
-        sum = Decimal('0.00')
-        for inv in active:
-            sum += inv.get_total()
-        context['active_sum'] = round(sum, 0)
-        #total passive invoices
-        sum = Decimal('0.00')
-        for inv in passive:
-            sum += inv.get_total()
-        context['passive_sum'] = round(sum, 0)
-        #total active invoices by category
-        active_cat = {}
-        active_left = Decimal('0.00')
-        for ch in choices:
-            if ch[0].startswith('A'):
-                act_cat = active.filter(category = ch[0])
-                sum = Decimal('0.00')
-                for act in act_cat:
-                    sum += act.get_total()
-                active_cat[ch[1].replace('A-', '')] = round(sum, 0)
-                active_left += sum
-            left = context['active_sum'] - active_left
-            active_cat[_('Other')] = round(left, 0)
-        context['active_cat'] = active_cat
-        #total active invoices by category
-        passive_cat = {}
-        passive_left = Decimal('0.00')
-        for ch in choices:
-            if ch[0].startswith('P'):
-                pass_cat = passive.filter(category = ch[0])
-                sum = Decimal('0.00')
-                for pasv in pass_cat:
-                    sum += pasv.get_total()
-                passive_cat[ch[1].replace('P-', '')] = round(sum, 0)
-                passive_left += sum
-            left = context['passive_sum'] - passive_left
-            passive_cat[_('Other')] = round(left, 0)
-        context['passive_cat'] = passive_cat
+        context.update(self.get_chart_data())
         return context
 
-class InvoiceYearArchiveView(PermissionRequiredMixin, ChartMixin, YearArchiveView):
+class PeriodCacheMixin:
+    """Serves dated items and chart data of the period from the cache,
+    rollups.refresh_periods() drops them when invoices change"""
+
+    def get_period(self):
+        if isinstance(self, MonthMixin):
+            return (int(self.get_year()), int(self.get_month()))
+        return (int(self.get_year()), None)
+
+    def get_dated_items(self):
+        #querysets pickle along with their results
+        return get_or_compute(*self.get_period(), 'items',
+            super(PeriodCacheMixin, self).get_dated_items)
+
+    def get_chart_data(self):
+        return get_or_compute(*self.get_period(), 'chart',
+            super(PeriodCacheMixin, self).get_chart_data)
+
+#invoices rendered by the year page, the others load on demand
+YEAR_SLICE = 50
+
+def get_year_paginator(year):
+    qs = Invoice.objects.filter(date__gte=date(year, 1, 1),
+        date__lt=date(year + 1, 1, 1))
+    return KeysetPaginator(qs, getattr(settings, 'ACCOUNTING_YEAR_SLICE',
+        YEAR_SLICE))
+
+class InvoiceYearArchiveView(InstrumentedViewMixin, PermissionRequiredMixin,
+    PeriodCacheMixin, ChartMixin, YearArchiveView):
     model = Invoice
     permission_required = 'accounting.view_invoice'
-    make_object_list = True
+    #only the first slice, see year_rows
+    make_object_list = False
     date_field = 'date'
     allow_future = True
     context_object_name = 'all_invoices'
     year_format = '%Y'
     allow_empty = True
 
-class InvoiceMonthArchiveView(PermissionRequiredMixin, ChartMixin, MonthArchiveView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = get_year_paginator(int(self.get_year())).page()
+        context['all_invoices'] = page.object_list
+        context['next_cursor'] = page.next_cursor
+        return context
+
+class InvoiceMonthArchiveView(InstrumentedViewMixin, PermissionRequiredMixin,
+    PeriodCacheMixin, ChartMixin, MonthArchiveView):
     model = Invoice
     permission_required = 'accounting.view_invoice'
     date_field = 'date'
@@ -126,9 +212,12 @@ class AddAnotherMixin:
             context['csv_created'] = self.request.GET['csv_created']
             context['csv_modified'] = self.request.GET['csv_modified']
             context['csv_failed'] = self.request.GET['csv_failed']
+        elif 'csv_job' in self.request.GET:
+            context['csv_job'] = self.request.GET['csv_job']
         return context
 
-class InvoiceCreateView(PermissionRequiredMixin, AddAnotherMixin, CreateView):
+class InvoiceCreateView(InstrumentedViewMixin, PermissionRequiredMixin,
+    AddAnotherMixin, CreateView):
     model = Invoice
     permission_required = 'accounting.add_invoice'
     form_class = InvoiceCreateForm
@@ -139,7 +228,8 @@ class InvoiceCreateView(PermissionRequiredMixin, AddAnotherMixin, CreateView):
         else:
             return reverse('invoices:index') + f'?created={self.object.number}'
 
-class InvoiceUpdateView(PermissionRequiredMixin, AddAnotherMixin, UpdateView):
+class InvoiceUpdateView(InstrumentedViewMixin, PermissionRequiredMixin,
+    AddAnotherMixin, UpdateView):
     model = Invoice
     permission_required = 'accounting.change_invoice'
     form_class = InvoiceCreateForm
@@ -151,7 +241,8 @@ class InvoiceUpdateView(PermissionRequiredMixin, AddAnotherMixin, UpdateView):
         else:
             return reverse('invoices:index') + f'?modified={self.object.number}'
 
-class InvoiceDeleteView(PermissionRequiredMixin, FormView):
+class InvoiceDeleteView(InstrumentedViewMixin, PermissionRequiredMixin,
+    FormView):
     model = Invoice
     permission_required = 'accounting.delete_invoice'
     form_class = InvoiceDeleteForm
@@ -166,7 +257,8 @@ class InvoiceDeleteView(PermissionRequiredMixin, FormView):
     def get_success_url(self):
         return reverse('invoices:index') + f'?deleted={self.number}'
 
-class CSVInvoiceCreateView(PermissionRequiredMixin, AddAnotherMixin, FormView):
+class CSVInvoiceCreateView(InstrumentedViewMixin, PermissionRequiredMixin,
+    AddAnotherMixin, FormView):
     model = CSVInvoice
     template_name = 'accounting/csvinvoice_form.html'
     permission_required = 'accounting.add_csvinvoice'
@@ -176,62 +268,271 @@ class CSVInvoiceCreateView(PermissionRequiredMixin, AddAnotherMixin, FormView):
         self.created = 0
         self.modified = 0
         self.failed = 0
+        self.job = None
         files = self.request.FILES.getlist('csv')
+        if getattr(settings, 'ACCOUNTING_QUEUE_UPLOADS', False):
+            #files are stored and left to process_invoice_files command
+            self.job = uuid.uuid4()
+            for f in files:
+                instance = CSVInvoice(csv=f, job=self.job, status='P')
+                instance.save()
+            return super(CSVInvoiceCreateView, self).form_valid(form)
+        #files are stored first, so that XML ones are parsed in parallel
+        instances = []
         for f in files:
-            instance = CSVInvoice(csv=f)
+            instance = CSVInvoice(csv=f, status='R')
             instance.save()
+            instances.append(instance)
+        parse_files(instances)
+        for instance in instances:
             self.created += instance.created
             self.modified += instance.modified
             self.failed += instance.failed
         return super(CSVInvoiceCreateView, self).form_valid(form)
 
     def get_success_url(self):
+        if self.job:
+            query = f'?csv_job={self.job}'
+        else:
+            query = f'?csv_created={self.created}&csv_modified={self.modified}&csv_failed={self.failed}'
         if 'add_another' in self.request.POST:
-            return (reverse('invoices:csv') +
-                f'?csv_created={self.created}&csv_modified={self.modified}&csv_failed={self.failed}')
+            return reverse('invoices:csv') + query
         else:
-            return (reverse('invoices:index') +
-                f'?csv_created={self.created}&csv_modified={self.modified}&csv_failed={self.failed}')
-
-def csv_writer(writer, qs):
-    writer.writerow([_('Number'), _('Client'), _('Active?'), _('dd/mm/yy'),
-        _('Description'), _('Taxable'), _('Social security'), _('VAT'),
-        _('Category'), _('Paid?')])
-    for i in qs:
-        active = 'yes' if i.active else ''
-        paid = 'yes' if i.paid else ''
-        date = datetime.strftime(i.date, '%d/%m/%y')
-        writer.writerow([i.number, i.client, active, date, i.descr,
-            i.amount, i.security, i.vat, i.category, paid])
-    return writer
+            return reverse('invoices:index') + query
 
+@instrument_view
 @permission_required('accounting.view_invoice')
-def year_download(request, year):
-    # Create the HttpResponse object with the appropriate CSV header.
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = ('attachment; filename="%(invoices)s-%(year)d.csv"' %
-        {'invoices': _('Invoices'), 'year': year})
+def year_rows(request, year):
+    """Table rows of the year after ?cursor=, as an HTML fragment along
+    with the cursor of the following ones"""
+    page = get_year_paginator(year).page(request.GET.get('cursor'))
+    html = render_to_string('accounting/invoice_rows.html',
+        {'all_invoices': page.object_list}, request=request)
+    return JsonResponse({'html': html, 'next': page.next_cursor,
+        'count': len(page)})
+
+def get_chart_payload(request, year, month=None):
+    """JSON of the period charts, shared with the pages through the period
+    cache and kept on the request for the ETag and the response"""
+    if not hasattr(request, 'chart_payload'):
+        if month is not None and not 1 <= month <= 12:
+            raise Http404(_("No such month"))
+        data = get_or_compute(year, month, 'chart',
+            lambda: get_period_chart_data(year, month))
+        request.chart_payload = json.dumps(dict(data, year=year, month=month),
+            cls=DjangoJSONEncoder, sort_keys=True)
+    return request.chart_payload
+
+def chart_etag(request, year, month=None):
+    payload = get_chart_payload(request, year, month)
+    return '"%s"' % hashlib.sha256(payload.encode()).hexdigest()
+
+def chart_last_modified(request, year, month=None):
+    #stamps outlive rollups of months left without invoices
+    stamps = PeriodStamp.objects.filter(year=year)
+    if month is not None:
+        stamps = stamps.filter(month=month)
+    return stamps.aggregate(last=Max('updated'))['last']
+
+@instrument_view
+@permission_required('accounting.view_invoice')
+@condition(etag_func=chart_etag, last_modified_func=chart_last_modified)
+def chart_data(request, year, month=None):
+    """Totals and categories of year and month charts, answers 304 if the
+    client has them already"""
+    return HttpResponse(get_chart_payload(request, year, month),
+        content_type='application/json')
+
+@instrument_view
+@permission_required('accounting.view_csvinvoice')
+def csv_job_status(request, job):
+    files = CSVInvoice.objects.filter(job=job).order_by('id')
+    if not files:
+        raise Http404(_("No such job"))
+    data = {'job': str(job), 'files': [], 'created': 0, 'modified': 0,
+        'failed': 0, 'done': True}
+    for f in files:
+        data['files'].append({'id': f.id, 'file': f.get_filename(),
+            'status': f.get_status_display(), 'created': f.created,
+            'modified': f.modified, 'failed': f.failed,
+            'duplicate_of': f.duplicate_of_id})
+        data['created'] += f.created
+        data['modified'] += f.modified
+        data['failed'] += f.failed
+        if f.status != 'D':
+            data['done'] = False
+    return JsonResponse(data)
+
+@instrument_view
+@permission_required('accounting.view_invoice')
+def period_cache_stats(request):
+    return JsonResponse(get_stats())
+
+def csv_response(qs, filename):
+    response = StreamingHttpResponse(csv_rows(qs), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
+@instrument_view
+@permission_required('accounting.view_invoice')
+def year_download(request, year):
     qs = Invoice.objects.filter(date__year=year)
+    return csv_response(qs, '%(invoices)s-%(year)d.csv' %
+        {'invoices': _('Invoices'), 'year': year})
 
-    writer = csv.writer(response)
-    writer = csv_writer(writer, qs)
+@instrument_view
+@permission_required('accounting.view_invoice')
+def month_download(request, year, month):
+    qs = Invoice.objects.filter(date__year=year).filter(date__month=month)
+    return csv_response(qs, '%(invoices)s-%(year)d-%(month)d.csv' %
+        {'invoices': _('Invoices'), 'year': year, 'month': month})
 
+@instrument_view
+@permission_required('accounting.view_invoice')
+def export_invoices(request):
+    """Streams invoices of a date range, gzip or zip compressed. Query
+    string takes start, end, active, category, paid and compression"""
+    form = InvoiceExportForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    cd = form.cleaned_data
+    compression = cd['compression']
+    qs = filter_invoices(cd['start'], cd['end'], active=cd['active'],
+        category=cd['category'], paid=cd['paid'])
+    name = '-'.join([_('Invoices')] + [d.isoformat()
+        for d in (cd['start'], cd['end']) if d])
+    response = StreamingHttpResponse(compress(csv_rows(qs), compression,
+        name + '.csv'), content_type=get_content_type(compression))
+    response['Content-Disposition'] = ('attachment; filename="%s%s"' %
+        (name, get_extension(compression)))
     return response
 
+def get_vat_report(request):
+    """Form of the query string and its report, None if it's invalid"""
+    form = VATReportForm(request.GET)
+    if not form.is_valid():
+        return form, None
+    cd = form.cleaned_data
+    return form, vat_liquidation(cd['start'], cd['end'], cd['period'])
+
+class VATReportView(InstrumentedViewMixin, PermissionRequiredMixin,
+    TemplateView):
+    permission_required = 'accounting.view_invoice'
+    template_name = 'accounting/vat_report.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['form'], context['report'] = get_vat_report(self.request)
+        context['query'] = self.request.GET.urlencode()
+        return context
+
+@instrument_view
 @permission_required('accounting.view_invoice')
-def month_download(request, year, month):
-    # Create the HttpResponse object with the appropriate CSV header.
+def vat_report_json(request):
+    form, report = get_vat_report(request)
+    if report is None:
+        return JsonResponse({'errors': form.errors}, status=400)
+    return JsonResponse(report)
+
+@instrument_view
+@permission_required('accounting.view_invoice')
+def vat_report_csv(request):
+    form, report = get_vat_report(request)
+    if report is None:
+        return JsonResponse({'errors': form.errors}, status=400)
     response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = ('attachment; filename="%(invoices)s-%(year)d-%(month)d.csv"' %
-        {'invoices': _('Invoices'), 'year': year, 'month': month})
+    response['Content-Disposition'] = ('attachment; filename="%s-%s-%s.csv"'
+        % (_('VAT'), report['start'].isoformat(), report['end'].isoformat()))
+    writer = csv.writer(response)
+    writer.writerow([_('Period'), _('Active VAT'), _('Passive VAT'),
+        _('Balance')])
+    for row in report['rows']:
+        writer.writerow([row['period'], row['active_vat'],
+            row['passive_vat'], row['balance']])
+    writer.writerow([_('Total'), report['active_vat'],
+        report['passive_vat'], report['balance']])
+    return response
 
-    qs = Invoice.objects.filter(date__year=year).filter(date__month=month)
+def get_aging_report(request):
+    """Form of the query string and its report, None if it's invalid"""
+    form = AgingReportForm(request.GET)
+    if not form.is_valid():
+        return form, None
+    return form, aging(form.cleaned_data['date'])
 
-    writer = csv.writer(response)
-    writer = csv_writer(writer, qs)
+class AgingReportView(InstrumentedViewMixin, PermissionRequiredMixin,
+    TemplateView):
+    permission_required = 'accounting.view_invoice'
+    template_name = 'accounting/aging_report.html'
 
-    return response
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['form'], context['report'] = get_aging_report(self.request)
+        context['query'] = self.request.GET.urlencode()
+        if context['report']:
+            context['report_parts'] = [
+                (_('Receivables'), context['report']['receivables']),
+                (_('Payables'), context['report']['payables'])]
+        return context
+
+@instrument_view
+@permission_required('accounting.view_invoice')
+def aging_report_json(request):
+    form, report = get_aging_report(request)
+    if report is None:
+        return JsonResponse({'errors': form.errors}, status=400)
+    return JsonResponse(report)
+
+def get_search_results(request):
+    """Form of the query string and ranked matches, none if it's invalid"""
+    form = InvoiceSearchForm(request.GET)
+    if not form.is_valid():
+        return form, Invoice.objects.none()
+    return form, search_invoices(form.cleaned_data['q'])
+
+class InvoiceSearchView(InstrumentedViewMixin, PermissionRequiredMixin,
+    ListView):
+    permission_required = 'accounting.view_invoice'
+    template_name = 'accounting/invoice_search.html'
+    context_object_name = 'all_invoices'
+    paginate_by = 50
+
+    def get_queryset(self):
+        self.form, results = get_search_results(self.request)
+        return results
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['form'] = self.form
+        context['q'] = self.request.GET.get('q', '')
+        return context
+
+@instrument_view
+@permission_required('accounting.view_invoice')
+def search_json(request):
+    form, results = get_search_results(request)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    page = Paginator(results, 50).get_page(request.GET.get('page'))
+    return JsonResponse({'count': page.paginator.count,
+        'page': page.number, 'num_pages': page.paginator.num_pages,
+        'results': [{'id': invoice.id, 'number': invoice.number,
+        'client': invoice.client, 'date': invoice.date,
+        'descr': invoice.descr, 'total': invoice.get_total(),
+        'rank': getattr(invoice, 'rank', None),
+        'url': reverse('invoices:change', args=[invoice.id])}
+        for invoice in page.object_list]})
+
+def metrics(request):
+    """Prometheus text of this process, when PrometheusBackend is on. Set
+    ACCOUNTING_METRICS_TOKEN to require it as a bearer token"""
+    if not any(isinstance(b, PrometheusBackend) for b in get_backends()):
+        raise Http404(_("Metrics are off"))
+    token = getattr(settings, 'ACCOUNTING_METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    return HttpResponse(PrometheusBackend.render(),
+        content_type='text/plain; version=0.0.4')
 
 #class CSVInvoiceMailTemplateView(PermissionRequiredMixin, TemplateView):
     #permission_required = 'accounting.view_invoice'